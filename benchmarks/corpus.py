@@ -0,0 +1,77 @@
+import random
+
+# Real messages from user reports and the bot's own help text
+SEED_MESSAGES = [
+    "phở 50k",
+    "ăn phở 50k",
+    "đổ xăng 100 nghìn",
+    "cafe 30k",
+    "gửi xe 5k",
+    "ăn trưa 45k",
+    "sáng phở 45k, trưa cơm 35k, tối cafe 30k",
+    "sửa thành 40k",
+    "Hôm nay tôi chi 50k ăn phở",
+    "Mua sách 200 nghìn",
+    "Đổ xăng 100k",
+    "Chiều nay mua sách 200k",
+    "Ăn phở bò 45 nghìn",
+    "chỉnh lại thành cà phê sữa 45 nghìn",
+    "đổi thành trà sữa 35k",
+]
+
+ITEMS = [
+    "phở", "bún bò", "cơm tấm", "bánh mì", "cafe", "trà sữa", "lẩu", "bia", "grab", "taxi",
+    "đổ xăng", "gửi xe", "vé xe", "quần áo", "giày", "shopee", "xem phim", "netflix", "karaoke",
+    "tiền điện", "tiền nước", "internet", "thuốc", "khám bệnh", "học phí", "sách",
+]
+PREFIXES = ["", "", "", "sáng ", "trưa ", "tối ", "hôm nay ", "mình ", "chiều nay "]
+AMOUNTS = ["{n}k", "{n}k", "{n} nghìn", "{n}.000", "{n}000đ"]
+
+# Messages the local fast path can't answer, so they exercise the LLM
+AMBIGUOUS = [
+    "hôm qua đi chợ hết 2 trăm", "phở 50", "trả nợ bạn 500", "mua đồ cho mẹ 300k ở siêu thị với bạn",
+    "tiền nhà tháng này 4tr5", "đi đám cưới 500k", "nạp điện thoại 100k", "tip cho shipper 20k",
+]
+MULTI_SEPARATORS = [", ", "; ", "\n"]
+EDITS = ["sửa thành {n}k", "đổi thành {item} {n}k", "chỉnh lại thành {n} nghìn", "cập nhật thành {item}"]
+GREETINGS = ["xin chào", "chào bot", "hello", "hi bạn"]
+QUESTIONS = ["làm sao để xem thống kê?", "có những danh mục nào?", "bot dùng thế nào?", "xem báo cáo ở đâu?"]
+
+# Share of each kind of message, roughly what production traffic looks like
+MIX = [("add", 0.6), ("ambiguous", 0.12), ("multi", 0.1), ("edit", 0.1), ("greeting", 0.04), ("question", 0.04)]
+
+def _amount(rng) -> str:
+    return rng.choice(AMOUNTS).format(n=rng.choice([5, 10, 15, 20, 25, 30, 35, 40, 45, 50, 60, 80, 100, 150, 200, 500]))
+
+def _add(rng) -> str:
+    return f"{rng.choice(PREFIXES)}{rng.choice(ITEMS)} {_amount(rng)}"
+
+def generate_message(rng, kind: str) -> str:
+    if kind == "add":
+        return _add(rng)
+    if kind == "ambiguous":
+        return rng.choice(AMBIGUOUS)
+    if kind == "multi":
+        return rng.choice(MULTI_SEPARATORS).join(_add(rng) for _ in range(rng.randint(2, 4)))
+    if kind == "edit":
+        return rng.choice(EDITS).format(n=rng.choice([20, 35, 40, 45, 60]), item=rng.choice(ITEMS))
+    if kind == "greeting":
+        return rng.choice(GREETINGS)
+    return rng.choice(QUESTIONS)
+
+def build_corpus(size: int, seed: int = 42) -> list:
+    """
+    A reproducible list of Vietnamese messages: the seed messages first, then
+    generated ones following MIX. The same size and seed always give the same corpus.
+    """
+    rng = random.Random(seed)
+    kinds = [kind for kind, _ in MIX]
+    weights = [weight for _, weight in MIX]
+    corpus = list(SEED_MESSAGES[:size])
+    while len(corpus) < size:
+        corpus.append(generate_message(rng, rng.choices(kinds, weights)[0]))
+    return corpus
+
+def expense_messages(corpus: list) -> list:
+    """Messages from the corpus that add expenses, for endpoints that only accept those."""
+    return [text for text in corpus if any(ch.isdigit() for ch in text) and not text.startswith(("sửa", "đổi", "chỉnh"))]
@@ -0,0 +1,201 @@
+"""
+Local stand-in for the OpenAI chat completions API and the Telegram Bot API, so
+benchmarks measure our code with a controlled, repeatable upstream latency.
+"""
+import re
+import json
+import time
+import random
+import asyncio
+import threading
+from itertools import count
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+from starlette.requests import ClientDisconnect
+
+from llm import fast_parse_message, guess_category, parse_amount, AMOUNT_MULTIPLIERS, EDIT_KEYWORDS
+
+GREETING_WORDS = ["chào", "hello", "hi"]
+_LOOSE_AMOUNT = re.compile(r"(\d+)\s*(tr|k|nghìn|trăm)?(\d)?", re.IGNORECASE)
+
+def _loose_amount(text: str):
+    """Reads what the fast path refuses ('phở 50', 'hết 2 trăm', '4tr5') the way the LLM would."""
+    match = _LOOSE_AMOUNT.search(text)
+    if not match:
+        return None
+    number, unit, fraction = int(match.group(1)), (match.group(2) or "").lower(), match.group(3)
+    if unit == "trăm":
+        return number * 100000
+    if fraction:
+        number += int(fraction) / 10
+    amount = number * AMOUNT_MULTIPLIERS.get(unit, 1)
+    return amount * 1000 if amount < 1000 else amount
+
+def _description(text: str) -> str:
+    description = " ".join(_LOOSE_AMOUNT.sub(" ", text).split()).strip(" ,.;:-!")
+    return (description[0].upper() + description[1:]) if description else "Chi tiêu"
+
+def canned_analysis(text: str, has_context: bool = False) -> dict:
+    """A plausible {"intent", "data"} answer for one message, derived deterministically from its text."""
+    lowered = text.lower()
+    fast_result = fast_parse_message(text)
+    if fast_result:
+        intent, data = fast_result
+        return {"intent": intent.value, "data": data}
+
+    if any(lowered.startswith(keyword) for keyword in EDIT_KEYWORDS):
+        parsed = parse_amount(text)
+        description = re.sub(r"^\S+(?:\s+lại)?\s+thành\s*", "", text, flags=re.IGNORECASE)
+        if parsed:
+            description = description.replace(text[parsed[1][0]:parsed[1][1]], "")
+        description = " ".join(description.split()) or None
+        return {"intent": "edit_expense", "data": {
+            "amount": parsed[0] if parsed else None,
+            "description": description,
+            "category": guess_category(description) if description else None,
+            "confidence": 0.9 if has_context else 0.6,
+            "needs_clarification": False,
+            "clarification_question": ""
+        }}
+
+    if "?" in text:
+        topic = "categories" if "danh mục" in lowered else "commands" if "báo cáo" in lowered else "expenses"
+        return {"intent": "question", "data": {"topic": topic, "should_show_help": True}}
+
+    if any(re.search(rf"(?<!\w){word}(?!\w)", lowered) for word in GREETING_WORDS):
+        return {"intent": "greeting", "data": {"should_show_help": True}}
+
+    amount = _loose_amount(text)
+    if amount:
+        description = _description(text)
+        return {"intent": "add_expense", "data": {
+            "amount": round(amount / 1000) * 1000,
+            "description": description,
+            "category": guess_category(description) or "other",
+            "confidence": 0.8,
+            "needs_clarification": False,
+            "clarification_question": ""
+        }}
+
+    return {"intent": "unclear", "data": {
+        "possible_intents": ["add_expense", "question"],
+        "clarification_question": "Bạn ơi, bạn đang muốn ghi chi tiêu hay đang có câu hỏi gì vậy?"
+    }}
+
+def _answer(messages: list) -> dict:
+    system, user = messages[0]["content"], messages[-1]["content"]
+    if "Trả về đúng một danh mục cho mỗi nội dung" in system:
+        return {"categories": [guess_category(description) or "other" for description in json.loads(user)]}
+    if "Chế độ xử lý nhiều tin nhắn" in system:
+        return {"results": [
+            {"id": item["id"], **canned_analysis(item["message"], "current_expense" in item)}
+            for item in json.loads(user)
+        ]}
+    text, _, context = user.partition("\n\nChi tiêu hiện tại")
+    answer = canned_analysis(text.removeprefix("Tin nhắn của người dùng: "), bool(context))
+    # Compact prompts only describe some intents and ask for "unclear" otherwise
+    if f'"intent": "{answer["intent"]}"' not in system:
+        return {"intent": "unclear", "data": {}}
+    return answer
+
+def create_app(latency_ms: float = 300, jitter_ms: float = 100, error_rate: float = 0.0, seed: int = 42):
+    """
+    The stand-in app. Every completion waits latency_ms ± jitter_ms, and
+    error_rate of them fail with a 429, 500 or 503 like a struggling upstream.
+    """
+    app = FastAPI()
+    rng = random.Random(seed)
+    message_ids = count(1)
+    app.state.stats = {"completions": 0, "errors": 0, "prompt_tokens": 0, "telegram_calls": 0}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        try:
+            body = await request.json()
+        except ClientDisconnect:
+            return Response(status_code=499)  # a hedged request that lost the race
+        stats = app.state.stats
+        stats["completions"] += 1
+        await asyncio.sleep(max(0.0, latency_ms + rng.uniform(-jitter_ms, jitter_ms)) / 1000)
+
+        if rng.random() < error_rate:
+            stats["errors"] += 1
+            status = rng.choice([429, 500, 503])
+            return JSONResponse(status_code=status, content={"error": {"message": "Injected failure", "type": "server_error"}})
+
+        content = json.dumps(_answer(body["messages"]), ensure_ascii=False)
+        prompt_tokens = sum(len(message["content"]) for message in body["messages"]) // 4
+        stats["prompt_tokens"] += prompt_tokens
+        return {
+            "id": f"chatcmpl-bench-{stats['completions']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "bench"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": len(content) // 4,
+                "total_tokens": prompt_tokens + len(content) // 4
+            }
+        }
+
+    @app.post("/bot{token}/{method}")
+    async def telegram(token: str, method: str, request: Request):
+        app.state.stats["telegram_calls"] += 1
+        form = await request.form()
+        if method == "getMe":
+            return {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}}
+        if method == "answerCallbackQuery":
+            return {"ok": True, "result": True}
+        return {"ok": True, "result": {
+            "message_id": next(message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(form.get("chat_id", 0)), "type": "private"},
+            "text": form.get("text", "")
+        }}
+
+    return app
+
+class FakeServer:
+    """Runs the stand-in app with uvicorn on a background thread: `with FakeServer(...) as server: server.url`."""
+
+    def __init__(self, port: int = 0, **options):
+        self.app = create_app(**options)
+        self._server = uvicorn.Server(uvicorn.Config(self.app, host="127.0.0.1", port=port, log_level="warning"))
+        self._thread = threading.Thread(target=self._server.run, name="fake-server", daemon=True)
+
+    @property
+    def stats(self) -> dict:
+        return self.app.state.stats
+
+    def __enter__(self):
+        self._thread.start()
+        while not self._server.started:
+            time.sleep(0.01)
+        port = self._server.servers[0].sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.should_exit = True
+        self._thread.join()
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve the fake OpenAI/Telegram APIs for manual testing")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument("--jitter-ms", type=float, default=100)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    uvicorn.run(create_app(args.latency_ms, args.jitter_ms, args.error_rate), host="127.0.0.1", port=args.port)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+"""
+Reproducible end-to-end benchmarks against local stand-ins for OpenAI and Telegram.
+
+    python -m benchmarks.run --messages 500 --concurrency 16 --output before.json
+    python -m benchmarks.run --messages 500 --concurrency 16 --compare before.json
+
+Run from the repository root. Each run uses a fresh SQLite database, no disk
+LLM cache, and a fixed-seed corpus, so two runs differ only by the code under test.
+"""
+import os
+import sys
+import json
+import math
+import time
+import asyncio
+import argparse
+import logging
+import tempfile
+import platform
+from types import SimpleNamespace
+
+from benchmarks.corpus import build_corpus, expense_messages
+
+SCENARIOS = ["analyze", "analyze_async", "handle_message", "webhook", "api"]
+BENCH_TOKEN = "123456:BENCH"
+BENCH_USER_BASE = 900000
+
+def percentile(values: list, p: float) -> float:
+    """Nearest-rank percentile of already sorted values."""
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+def summarize(latencies: list, seconds: float, errors: int = 0) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "count": len(latencies),
+        "errors": errors,
+        "seconds": seconds,
+        "throughput": len(latencies) / seconds if seconds else 0.0,
+        "mean_ms": sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+def configure_environment(directory: str, options):
+    """Gives the project modules a throwaway database and no disk LLM cache. Must run before importing them."""
+    os.environ.update({
+        "OPENAI_API_KEY": "bench",
+        "TELEGRAM_BOT_TOKEN": BENCH_TOKEN,
+        "DATABASE_URL": f"sqlite:///{os.path.join(directory, 'bench.db')}",
+        "LLM_CACHE_PATH": "",
+        "METRICS_PORT": "0",
+    })
+    if options.no_cache:
+        os.environ["LLM_CACHE_MAX_SIZE"] = "0"
+
+def point_at(fake_url: str):
+    """Sends OpenAI and Bot API calls to the stand-in. The clients read these on first use."""
+    os.environ["OPENAI_BASE_URL"] = f"{fake_url}/v1"
+    os.environ["TELEGRAM_API_BASE_URL"] = f"{fake_url}/bot"
+
+async def _gather_limited(concurrency: int, coroutines):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(limited(coroutine) for coroutine in coroutines))
+
+def _failed_analyses(unclear: bool = True) -> int:
+    """
+    Messages answered so far without the LLM because its call failed (llm.FAILED_SOURCES
+    in llm_analyze_seconds). With unclear=False, only those answered as an expense or edit.
+    """
+    from llm import FAILED_SOURCES, MessageIntent
+    from metrics import LLM_ANALYZE_SECONDS
+
+    return sum(
+        LLM_ANALYZE_SECONDS.count(intent=intent.value, source=source)
+        for source in FAILED_SOURCES for intent in MessageIntent
+        if unclear or intent != MessageIntent.UNCLEAR
+    )
+
+def bench_analyze(corpus, options):
+    """analyze_message, one call at a time, as the sync callers use it."""
+    from llm import analyze_message
+
+    latencies, failed = [], _failed_analyses()
+    start = time.perf_counter()
+    for text in corpus:
+        call_start = time.perf_counter()
+        analyze_message(text)
+        latencies.append(time.perf_counter() - call_start)
+    return {"analyze_message": summarize(latencies, time.perf_counter() - start, _failed_analyses() - failed)}
+
+async def bench_analyze_async(corpus, options):
+    """analyze_message_async with `concurrency` callers, as the bot and web handlers use it."""
+    from llm import analyze_message_async
+
+    async def call(text):
+        call_start = time.perf_counter()
+        await analyze_message_async(text)
+        return time.perf_counter() - call_start
+
+    failed = _failed_analyses()
+    start = time.perf_counter()
+    latencies = await _gather_limited(options.concurrency, [call(text) for text in corpus])
+    return {"analyze_message_async": summarize(
+        latencies, time.perf_counter() - start, _failed_analyses() - failed
+    )}
+
+def _fake_update(text: str, user_id: int, replies: list):
+    async def reply_text(reply, **kwargs):
+        replies.append(reply)
+
+    user = SimpleNamespace(id=user_id)
+    message = SimpleNamespace(text=text, reply_text=reply_text, from_user=user)
+    return SimpleNamespace(message=message, effective_user=user, effective_message=message)
+
+async def bench_handle_message(corpus, options):
+    """bot.handle_message end to end (LLM, database, reply), scheduled like the bot schedules updates."""
+    from bot import handle_message, PerUserUpdateProcessor
+
+    processor = PerUserUpdateProcessor(options.concurrency, len(corpus))
+    latencies, replies = [], []
+
+    async def call(update):
+        call_start = time.perf_counter()
+        await handle_message(update, None)
+        latencies.append(time.perf_counter() - call_start)
+
+    failed = _failed_analyses()
+    start = time.perf_counter()
+    updates = [_fake_update(text, BENCH_USER_BASE + index % options.users, replies) for index, text in enumerate(corpus)]
+    await asyncio.gather(*(processor.do_process_update(update, call(update)) for update in updates))
+    errors = len(corpus) - len(replies) + _failed_analyses() - failed
+    return {"handle_message": summarize(latencies, time.perf_counter() - start, errors)}
+
+def _telegram_update(update_id: int, user_id: int, text: str) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": "Bench"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user,
+            "text": text
+        }
+    }
+
+async def bench_webhook(corpus, options):
+    """
+    POST /webhook with real Telegram update JSON. "ack" is how fast Telegram gets
+    its 200; "processed" is from the POST until the reply went out to the Bot API.
+    """
+    import httpx
+    import web
+
+    await web.start_bot()
+    received, processed = {}, []
+    process = web.update_queue._process
+
+    async def timed_process(update):
+        await process(update)
+        processed.append(time.perf_counter() - received[update.update_id])
+
+    web.update_queue._process = timed_process
+    failed = _failed_analyses()
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=web.app), base_url="http://bench") as client:
+            async def post(update_id, text):
+                received[update_id] = time.perf_counter()
+                response = await client.post("/webhook", json=_telegram_update(
+                    update_id, BENCH_USER_BASE + update_id % options.users, text
+                ))
+                return time.perf_counter() - received[update_id], response.status_code
+
+            start = time.perf_counter()
+            results = await _gather_limited(options.concurrency, [post(index, text) for index, text in enumerate(corpus, 1)])
+            ack_seconds = time.perf_counter() - start
+            while web.update_queue.depth:
+                await asyncio.sleep(0.005)
+            drain_seconds = time.perf_counter() - start
+    finally:
+        web.update_queue._process = process
+        await web.stop_bot()
+
+    acks = [seconds for seconds, _ in results]
+    errors = sum(status != 200 for _, status in results)
+    return {
+        "webhook ack": summarize(acks, ack_seconds, errors),
+        "webhook processed": summarize(
+            processed, drain_seconds, len(corpus) - len(processed) + _failed_analyses() - failed
+        ),
+    }
+
+async def bench_api(corpus, options):
+    """
+    The dashboard's JSON API from `concurrency` logged-in browsers: every fourth
+    request adds an expense, the rest poll stats and the expense list. Browsers
+    send back the ETags they got, unless --no-etag.
+    """
+    import httpx
+    import web
+
+    messages = expense_messages(corpus) or corpus
+    latencies = {"POST /api/expenses": [], "GET /api/stats": [], "GET /api/expenses": []}
+    errors = dict.fromkeys(latencies, 0)
+
+    async def browser(worker: int):
+        etags = {}
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=web.app), base_url="http://bench") as client:
+            await client.post("/login", data={"user_id": BENCH_USER_BASE + worker % options.users})
+            for index in range(worker, len(corpus), options.concurrency):
+                if index % 4 == 0:
+                    name, request = "POST /api/expenses", client.post(
+                        "/api/expenses", data={"raw_text": messages[index % len(messages)]}
+                    )
+                else:
+                    path = "/api/stats" if index % 2 else "/api/expenses"
+                    headers = {"If-None-Match": etags[path]} if path in etags and not options.no_etag else {}
+                    name, request = f"GET {path}", client.get(path, params={"days": 30}, headers=headers)
+
+                call_start = time.perf_counter()
+                response = await request
+                latencies[name].append(time.perf_counter() - call_start)
+                if response.status_code >= 400:
+                    errors[name] += 1
+                elif "etag" in response.headers and name.startswith("GET"):
+                    etags[name[4:]] = response.headers["etag"]
+
+    # Failed analyses answered as unclear already show up as 400s
+    failed = _failed_analyses(unclear=False)
+    start = time.perf_counter()
+    await asyncio.gather(*(browser(worker) for worker in range(options.concurrency)))
+    seconds = time.perf_counter() - start
+    errors["POST /api/expenses"] += _failed_analyses(unclear=False) - failed
+    return {f"api {name}": summarize(values, seconds, errors[name]) for name, values in latencies.items()}
+
+def print_report(results: dict, baseline: dict = None):
+    columns = ["count", "errors", "throughput", "p50_ms", "p95_ms", "p99_ms", "mean_ms"]
+    print(f"{'scenario':<28}" + "".join(f"{column:>12}" for column in columns))
+    for name, result in results.items():
+        print(f"{name:<28}" + "".join(
+            f"{result[column]:>12.2f}" if isinstance(result[column], float) else f"{result[column]:>12}"
+            for column in columns
+        ))
+        previous = (baseline or {}).get(name)
+        if previous:
+            print(f"{'  vs baseline':<28}{'':>24}" + "".join(
+                f"{_change(previous[column], result[column]):>12}" for column in columns[2:]
+            ))
+
+def _change(before: float, after: float) -> str:
+    if not before:
+        return "-"
+    return f"{(after - before) / before * 100:+.1f}%"
+
+def _reset_response_cache():
+    """Every scenario starts with a cold in-memory cache, so the order of scenarios doesn't matter."""
+    import llm
+
+    cache = llm.response_cache
+    llm.response_cache = llm.ResponseCache(max_size=cache.max_size, ttl=cache.ttl)
+
+async def _run_async(scenarios, corpus, options):
+    results = {}
+    for scenario in scenarios:
+        _reset_response_cache()
+        if scenario == "analyze":
+            results.update(await asyncio.to_thread(bench_analyze, corpus, options))
+        else:
+            results.update(await globals()[f"bench_{scenario}"](corpus, options))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths against local OpenAI/Telegram stand-ins")
+    parser.add_argument("--messages", type=int, default=500, help="Corpus size per scenario")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent callers in the async scenarios")
+    parser.add_argument("--users", type=int, default=50, help="Distinct Telegram users the messages come from")
+    parser.add_argument("--seed", type=int, default=42, help="Corpus and upstream latency seed")
+    parser.add_argument("--llm-latency-ms", type=float, default=300, help="Mean completion latency")
+    parser.add_argument("--llm-jitter-ms", type=float, default=100, help="Completion latency spread (uniform ±)")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="Share of completions failing with 429/5xx")
+    parser.add_argument("--no-cache", action="store_true", help="Disable the in-memory LLM response cache")
+    parser.add_argument("--no-etag", action="store_true", help="API clients don't send If-None-Match")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--compare", help="Show changes against a previous --output file")
+    options = parser.parse_args()
+
+    sys.path.insert(0, os.getcwd())
+    # Configured first, so bot.py's INFO logging of every request stays out of the report
+    logging.basicConfig(level=logging.WARNING)
+    corpus = build_corpus(options.messages, options.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        configure_environment(directory, options)
+        from benchmarks.fake_server import FakeServer
+
+        with FakeServer(
+            latency_ms=options.llm_latency_ms, jitter_ms=options.llm_jitter_ms,
+            error_rate=options.llm_error_rate, seed=options.seed
+        ) as server:
+            point_at(server.url)
+            results = asyncio.run(_run_async(options.scenarios, corpus, options))
+            upstream = dict(server.stats)
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as file:
+            baseline = json.load(file)["results"]
+    print_report(results, baseline)
+    print(f"\nupstream: {upstream['completions']} completions ({upstream['errors']} failed), "
+          f"~{upstream['prompt_tokens']} prompt tokens, {upstream['telegram_calls']} Bot API calls")
+
+    if options.output:
+        with open(options.output, "w") as file:
+            json.dump({
+                "options": {key: value for key, value in vars(options).items() if key not in ("output", "compare")},
+                "python": platform.python_version(),
+                "upstream": upstream,
+                "results": results
+            }, file, indent=2)
+
+if __name__ == '__main__':
+    main()
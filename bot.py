@@ -1,15 +1,21 @@
 import os
+import asyncio
+import tempfile
 from datetime import datetime, timedelta
 import logging
 from dotenv import load_dotenv
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters
-import matplotlib.pyplot as plt
-from io import BytesIO
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import MessageLimit
+from telegram.ext import Application, BaseUpdateProcessor, CallbackQueryHandler, CommandHandler, MessageHandler, ContextTypes, filters
 import re
 
-from database import Database
-from llm import analyze_message, MessageIntent, format_expense_message, format_amount
+from database import create_async_database, encode_cursor
+from charts import get_stats_chart
+from exporter import export_expenses, export_filename
+from events import publish_expenses
+from classifier import is_confident, remember_expenses, train_from_history
+import metrics
+from llm import analyze_message_async, MessageIntent, format_expense_message, format_amount
 
 # Setup logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -18,8 +24,62 @@ logger = logging.getLogger(__name__)
 # Load environment variables
 load_dotenv()
 
-# Initialize database
-db = Database()
+_db = None
+
+def get_db():
+    """
+    The bot's database, created on first use rather than at import: chart workers
+    are spawned processes that re-import this module under `python bot.py`, and
+    must not connect to the database or run its migrations.
+    """
+    global _db
+    if _db is None:
+        _db = create_async_database()
+    return _db
+
+BOT_CONCURRENCY = int(os.getenv('BOT_CONCURRENCY', 16))
+BOT_MAX_PENDING_UPDATES = int(os.getenv('BOT_MAX_PENDING_UPDATES', 1024))
+REPORT_PAGE_SIZE = int(os.getenv('REPORT_PAGE_SIZE', 30))
+REPORT_DESCRIPTION_MAX_LENGTH = 80
+TELEGRAM_API_BASE_URL = os.getenv('TELEGRAM_API_BASE_URL')  # e.g. a local Bot API server or the benchmark stand-in
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes up to `concurrency` updates at once, but each user's updates one at
+    a time and in arrival order, so "ăn phở 50k" followed by "sửa thành 40k"
+    can't race. A user waiting on their own lock doesn't hold a concurrency slot.
+    """
+
+    def __init__(self, concurrency: int, max_pending_updates: int):
+        super().__init__(max_pending_updates)
+        self._slots = asyncio.Semaphore(concurrency)
+        self._locks = {}
+
+    async def do_process_update(self, update, coroutine):
+        user = getattr(update, "effective_user", None)
+        if user is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        entry = self._locks.get(user.id)
+        if entry is None:
+            entry = self._locks[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._slots:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[user.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
 
 def is_similar_to_command(text: str) -> tuple[bool, str]:
     """Check if text is similar to a known command."""
@@ -27,6 +87,7 @@ def is_similar_to_command(text: str) -> tuple[bool, str]:
         "report": r"^/rep[oóòỏõọôồốổỗộơớờởỡợ]?[rt]t?$",
         "stats": r"^/st[aáàảãạăắằẳẵặâấầẩẫậ]?ts?$",
         "help": r"^/h[eéèẻẽẹ]?lp?$",
+        "export": r"^/e?xp[oóòỏõọôồốổỗộơớờởỡợ]?[rt]t?$",
         "start": r"^/st[aáàảãạăắằẳẵặâấầẩẫậ]?[rt]t?$"
     }
     
@@ -46,6 +107,7 @@ Các lệnh có sẵn:
 /help - Xem hướng dẫn sử dụng
 /report - Xem báo cáo chi tiêu
 /stats - Xem thống kê chi tiêu theo danh mục
+/export - Tải toàn bộ chi tiêu dưới dạng file
 
 Để ghi nhận chi tiêu, bạn chỉ cần nhắn tin với tôi theo ngôn ngữ tự nhiên.
 Ví dụ: "Hôm nay tôi chi 50k ăn phở"
@@ -84,7 +146,11 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /stats - Xem thống kê theo danh mục 7 ngày gần nhất
 /stats 30 - Xem thống kê theo danh mục 30 ngày gần nhất
 
-5️⃣ Danh mục chi tiêu:
+5️⃣ Xuất dữ liệu:
+/export - Tải toàn bộ chi tiêu dạng CSV
+/export jsonl 30 - Tải chi tiêu 30 ngày gần nhất dạng JSONL (hỗ trợ csv, jsonl, parquet)
+
+6️⃣ Danh mục chi tiêu:
 - 🍜 Ăn uống (food)
 - 🚗 Di chuyển (transport)
 - 🛍️ Mua sắm (shopping)
@@ -98,8 +164,46 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     await update.message.reply_text(help_text)
 
+async def build_report_page(user_id: int, days: int, page: int = 1, cursor: str = None):
+    """
+    Builds one report message from a single page of expenses, kept under
+    Telegram's message length limit. Returns (text, reply_markup) or None if
+    there is nothing to report.
+    """
+    start_date = datetime.now() - timedelta(days=days)
+    expenses, next_cursor = await get_db().get_expenses_page(user_id, start_date, limit=REPORT_PAGE_SIZE, cursor=cursor)
+    if not expenses:
+        return None
+
+    report_text = f"📊 Báo cáo chi tiêu {days} ngày qua"
+    report_text += f" (trang {page}):\n\n" if page > 1 else ":\n\n"
+
+    footer = ""
+    if page == 1:
+        # The rollup answers the total without reading every expense
+        total = sum((await get_db().get_stats(user_id, start_date)).values())
+        footer = f"\n💰 Tổng chi tiêu: {total:,.0f}đ"
+
+    for index, expense in enumerate(expenses):
+        description = expense.description or ""
+        if len(description) > REPORT_DESCRIPTION_MAX_LENGTH:
+            description = description[:REPORT_DESCRIPTION_MAX_LENGTH - 1] + "…"
+        line = f"- {expense.date.strftime('%d/%m/%Y')}: {expense.amount:,.0f}đ - {description}\n"
+        if len(report_text) + len(line) + len(footer) > MessageLimit.MAX_TEXT_LENGTH:
+            # Continue the next page right after the last line that fit
+            next_cursor = encode_cursor(expenses[index - 1])
+            break
+        report_text += line
+
+    reply_markup = None
+    if next_cursor:
+        reply_markup = InlineKeyboardMarkup([[
+            InlineKeyboardButton("Trang sau ▶️", callback_data=f"report:{days}:{page + 1}:{next_cursor}")
+        ]])
+    return report_text + footer, reply_markup
+
 async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Generate expense report."""
+    """Generate expense report, one page per message."""
     user_id = update.effective_user.id
     
     # Get number of days from command arguments
@@ -107,21 +211,30 @@ async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if context.args and context.args[0].isdigit():
         days = int(context.args[0])
     
-    start_date = datetime.now() - timedelta(days=days)
-    expenses = db.get_expenses(user_id, start_date)
-    
-    if not expenses:
+    result = await build_report_page(user_id, days)
+    if not result:
         await update.message.reply_text(f"Không có chi tiêu nào trong {days} ngày qua.")
         return
     
-    total = sum(expense.amount for expense in expenses)
-    report_text = f"📊 Báo cáo chi tiêu {days} ngày qua:\n\n"
-    
-    for expense in expenses:
-        report_text += f"- {expense.date.strftime('%d/%m/%Y')}: {expense.amount:,.0f}đ - {expense.description}\n"
-    
-    report_text += f"\n💰 Tổng chi tiêu: {total:,.0f}đ"
-    await update.message.reply_text(report_text)
+    report_text, reply_markup = result
+    await update.message.reply_text(report_text, reply_markup=reply_markup)
+
+async def report_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send the next report page when its inline button is pressed."""
+    query = update.callback_query
+    await query.answer()
+    _, days, page, cursor = query.data.split(":", 3)
+
+    # The button has done its job; drop it so the page can't be requested twice
+    await query.edit_message_reply_markup(reply_markup=None)
+
+    result = await build_report_page(update.effective_user.id, int(days), int(page), cursor)
+    if not result:
+        await query.message.reply_text("Không còn chi tiêu nào để hiển thị.")
+        return
+
+    report_text, reply_markup = result
+    await query.message.reply_text(report_text, reply_markup=reply_markup)
 
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Generate expense statistics with pie chart."""
@@ -133,22 +246,14 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         days = int(context.args[0])
     
     start_date = datetime.now() - timedelta(days=days)
-    stats_data = db.get_stats(user_id, start_date)
+    stats_data = await get_db().get_stats(user_id, start_date)
     
     if not stats_data:
         await update.message.reply_text(f"Không có chi tiêu nào trong {days} ngày qua.")
         return
     
-    # Create pie chart
-    plt.figure(figsize=(10, 7))
-    plt.pie(stats_data.values(), labels=stats_data.keys(), autopct='%1.1f%%')
-    plt.title(f'Thống kê chi tiêu theo danh mục ({days} ngày qua)')
-    
-    # Save plot to buffer
-    buf = BytesIO()
-    plt.savefig(buf, format='png')
-    buf.seek(0)
-    plt.close()
+    # Create pie chart (rendered off the event loop, cached per stats and range)
+    chart = await get_stats_chart(stats_data, days)
     
     # Send statistics and plot
     total = sum(stats_data.values())
@@ -157,12 +262,42 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         stats_text += f"- {category}: {amount:,.0f}đ ({amount/total*100:.1f}%)\n"
     stats_text += f"\n💰 Tổng chi tiêu: {total:,.0f}đ"
     
-    await update.message.reply_photo(buf, caption=stats_text)
+    await update.message.reply_photo(chart, caption=stats_text)
+
+async def export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send the user's expenses as a CSV, JSONL or Parquet document."""
+    user_id = update.effective_user.id
+
+    # Arguments in any order: a format and/or a number of days
+    export_format, days = "csv", None
+    for arg in context.args or []:
+        if arg.isdigit():
+            days = int(arg)
+        else:
+            export_format = arg.lower()
+
+    start_date = datetime.now() - timedelta(days=days) if days else None
+    try:
+        content = export_expenses(get_db(), user_id, export_format, start_date=start_date)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}")
+        return
+
+    # Spool to disk past 1 MB so long histories don't sit in memory
+    with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as file:
+        async for data in content:
+            file.write(data)
+        file.seek(0)
+        period = f"{days} ngày qua" if days else "toàn bộ"
+        await update.message.reply_document(
+            file, filename=export_filename(export_format), caption=f"📁 Chi tiêu ({period})"
+        )
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle incoming messages using LLM for intent analysis."""
     text = update.message.text
     user_id = update.effective_user.id
+    db = get_db()
     
     # Check if this is a misspelled command first
     is_misspelled, actual_command = is_similar_to_command(text)
@@ -175,7 +310,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Get the most recent expense for context
     recent_expense = None
-    intent, data = analyze_message(text)
+    await train_from_history(db, user_id)
+    intent, data = await analyze_message_async(text, user_id=user_id)
     
     if intent == MessageIntent.GREETING:
         message = "👋 Chào bạn! Tôi là bot quản lý chi tiêu."
@@ -221,7 +357,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     elif intent == MessageIntent.EDIT_EXPENSE:
-        recent_expense = db.get_latest_expense(user_id)
+        recent_expense = await db.get_latest_expense(user_id)
         if not recent_expense:
             await update.message.reply_text(
                 "❌ Không tìm thấy chi tiêu nào để chỉnh sửa.\n"
@@ -235,20 +371,24 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Update the expense
         changes = []
+        updates = {}
         if data["amount"] is not None and data["amount"] != recent_expense.amount:
             changes.append(f"💰 Số tiền: {format_amount(recent_expense.amount)}đ ➡️ {format_amount(data['amount'])}đ")
-            recent_expense.amount = data["amount"]
+            updates["amount"] = data["amount"]
             
         if data["description"] is not None and data["description"] != recent_expense.description:
             changes.append(f"📝 Mô tả: {recent_expense.description} ➡️ {data['description']}")
-            recent_expense.description = data["description"]
+            updates["description"] = data["description"]
             
         if data["category"] is not None and data["category"] != recent_expense.category:
             changes.append(f"🏷️ Danh mục: {recent_expense.category} ➡️ {data['category']}")
-            recent_expense.category = data["category"]
+            updates["category"] = data["category"]
         
-        recent_expense.raw_text = text
-        db.session.commit()
+        learn = ("description" in updates or "category" in updates) and is_confident(data)
+        expense = await db.update_expense(recent_expense.id, user_id=user_id, raw_text=text, learn=learn, **updates)
+        if learn:
+            remember_expenses(user_id, [expense])
+        await publish_expenses(db, user_id, "updated", [expense] if expense else [])
         
         # Send confirmation with changes
         if changes:
@@ -276,17 +416,45 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         # Save to database
-        expense = db.add_expense(
+        expense = await db.add_expense(
             user_id=user_id,
             amount=data["amount"],
             description=data["description"],
             category=data["category"],
-            raw_text=text
+            raw_text=text,
+            learn=is_confident(data)
         )
-        
+        if is_confident(data):
+            remember_expenses(user_id, [expense])
+
         # Send confirmation
         await update.message.reply_text(format_expense_message(data))
+        await publish_expenses(db, user_id, "created", [expense])
     
+    elif intent == MessageIntent.ADD_EXPENSES:
+        if data.get("needs_clarification", False):
+            await update.message.reply_text(data["clarification_question"])
+            return
+
+        expenses = [expense for expense in data.get("expenses", []) if expense.get("amount") is not None]
+        if not expenses:
+            await update.message.reply_text(
+                "❌ Không thể hiểu số tiền chi tiêu. Vui lòng thử lại với cú pháp:\n"
+                "- [Mô tả] [Số tiền], [Mô tả] [Số tiền]\n"
+                "Ví dụ:\n"
+                "- Sáng phở 45k, trưa cơm 35k, tối cafe 30k"
+            )
+            return
+
+        # Save all of them in one transaction
+        items = [dict(expense, learn=is_confident(expense)) for expense in expenses]
+        saved = await db.add_expenses(user_id=user_id, expenses=items, raw_text=text)
+        remember_expenses(user_id, [expense for expense, item in zip(saved, items) if item["learn"]])
+
+        # Send one combined confirmation
+        await update.message.reply_text(format_expense_message({"expenses": expenses}))
+        await publish_expenses(db, user_id, "created", saved)
+
     elif intent == MessageIntent.UNCLEAR:
         if data.get("clarification_question"):
             message = data["clarification_question"]
@@ -305,21 +473,39 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "- Đổ xăng 100k"
         )
 
+def timed(command: str, handler):
+    """Wraps a handler so its latency lands in telegram_handler_seconds{command}."""
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        with metrics.TELEGRAM_HANDLER_SECONDS.time(command=command):
+            return await handler(update, context)
+    return wrapper
+
 def setup_bot(application: Application):
     """Setup bot handlers."""
     # Add handlers
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("report", report))
-    application.add_handler(CommandHandler("stats", stats))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(CommandHandler("start", timed("start", start)))
+    application.add_handler(CommandHandler("help", timed("help", help_command)))
+    application.add_handler(CommandHandler("report", timed("report", report)))
+    application.add_handler(CommandHandler("stats", timed("stats", stats)))
+    application.add_handler(CommandHandler("export", timed("export", export)))
+    application.add_handler(CallbackQueryHandler(timed("report_page", report_page), pattern=r"^report:"))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed("message", handle_message)))
     return application
 
+def build_application(token: str = None) -> Application:
+    """Creates the Application with concurrent, per-user ordered update processing and our handlers."""
+    builder = Application.builder()\
+        .token(token or os.getenv('TELEGRAM_BOT_TOKEN'))\
+        .concurrent_updates(PerUserUpdateProcessor(BOT_CONCURRENCY, BOT_MAX_PENDING_UPDATES))
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(TELEGRAM_API_BASE_URL)
+    return setup_bot(builder.build())
+
 def main():
     """Start the bot."""
     # Create the Application
-    application = Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN')).build()
-    setup_bot(application)
+    application = build_application()
+    metrics.start_http_server()
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
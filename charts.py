@@ -0,0 +1,74 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from metrics import CHART_RENDER_SECONDS
+
+CHART_WORKERS = int(os.getenv('CHART_WORKERS', 2))
+CHART_CACHE_SIZE = int(os.getenv('CHART_CACHE_SIZE', 256))
+
+_executor = None
+_cache = OrderedDict()
+
+def render_stats_chart(stats_data: dict, days: int) -> bytes:
+    """
+    Renders the category pie chart as PNG bytes.
+    Uses the object-oriented Figure API on the Agg canvas, so no pyplot global state is involved.
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    figure = Figure(figsize=(10, 7))
+    FigureCanvasAgg(figure)
+    ax = figure.subplots()
+    ax.pie(list(stats_data.values()), labels=list(stats_data.keys()), autopct='%1.1f%%')
+    ax.set_title(f'Thống kê chi tiêu theo danh mục ({days} ngày qua)')
+
+    buf = BytesIO()
+    figure.savefig(buf, format='png')
+    return buf.getvalue()
+
+def _warm_up():
+    """Loads matplotlib once per worker so the first chart doesn't pay for the import."""
+    import matplotlib.figure
+    import matplotlib.backends.backend_agg
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # spawn keeps the workers free of the bot's threads and event loop
+        _executor = ProcessPoolExecutor(
+            max_workers=CHART_WORKERS,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_warm_up
+        )
+    return _executor
+
+def _cache_key(stats_data: dict, days: int) -> str:
+    # str() so a None category (legacy rows) still sorts next to real ones
+    payload = json.dumps([sorted(stats_data.items(), key=lambda item: str(item[0])), days], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+async def get_stats_chart(stats_data: dict, days: int) -> bytes:
+    """Returns the PNG for these stats, rendering it in a worker process unless it is cached."""
+    start = time.perf_counter()
+    key = _cache_key(stats_data, days)
+    if key in _cache:
+        _cache.move_to_end(key)
+        CHART_RENDER_SECONDS.observe(time.perf_counter() - start, cached="true")
+        return _cache[key]
+
+    loop = asyncio.get_running_loop()
+    png = await loop.run_in_executor(_get_executor(), render_stats_chart, dict(stats_data), days)
+    CHART_RENDER_SECONDS.observe(time.perf_counter() - start, cached="false")
+
+    _cache[key] = png
+    while len(_cache) > CHART_CACHE_SIZE:
+        _cache.popitem(last=False)
+    return png
@@ -0,0 +1,258 @@
+import os
+import math
+import heapq
+import threading
+import unicodedata
+from collections import Counter, OrderedDict, defaultdict
+
+CLASSIFIER_MAX_EXAMPLES = int(os.getenv('CLASSIFIER_MAX_EXAMPLES', 1000))
+CLASSIFIER_MIN_CONFIDENCE = float(os.getenv('CLASSIFIER_MIN_CONFIDENCE', 0.75))
+CLASSIFIER_CACHE_USERS = int(os.getenv('CLASSIFIER_CACHE_USERS', 1000))
+# Answers below this are guesses (the bot asks the user to check them), not examples
+CLASSIFIER_LEARN_CONFIDENCE = float(os.getenv('CLASSIFIER_LEARN_CONFIDENCE', 0.7))
+CLASSIFIER_MIN_SIMILARITY = 0.6
+CLASSIFIER_NEIGHBOURS = 5
+NGRAM_SIZE = 3
+
+def normalize_description(text: str) -> str:
+    text = unicodedata.normalize("NFC", text or "").lower()
+    return " ".join(text.split()).strip(" ,.;:-!")
+
+def is_confident(answer: dict) -> bool:
+    """Whether an analyzed expense (or edit) is sure enough to teach the classifier."""
+    return not answer.get("needs_clarification") and answer.get("confidence", 1.0) >= CLASSIFIER_LEARN_CONFIDENCE
+
+def unique_examples(examples) -> list:
+    """
+    (description, category) pairs with descriptions normalized, blanks dropped
+    and each description kept once, where it was taught last.
+    """
+    taught = {}
+    for description, category in examples:
+        description = normalize_description(description)
+        if description and category:
+            taught.pop(description, None)
+            taught[description] = category
+    return list(taught.items())
+
+def char_ngrams(text: str) -> frozenset:
+    """Character trigrams of the padded description, so 'highlands' still matches 'cafe highlands'."""
+    padded = f" {text} "
+    return frozenset(padded[i:i + NGRAM_SIZE] for i in range(len(padded) - NGRAM_SIZE + 1))
+
+class _UserModel:
+    """
+    One user's examples (description -> category), least recently taught first, with
+    an n-gram index, as of `version` of their examples in the database.
+    """
+
+    def __init__(self, version: int = 0, trained: bool = False):
+        self.version = version
+        self.trained = trained
+        self.examples = OrderedDict()
+        self.index = defaultdict(set)
+
+    def add(self, description: str, category: str):
+        self.remove(description)
+        grams = char_ngrams(description)
+        self.examples[description] = (category, grams)
+        for gram in grams:
+            self.index[gram].add(description)
+
+    def remove(self, description: str):
+        example = self.examples.pop(description, None)
+        if example:
+            for gram in example[1]:
+                self.index[gram].discard(description)
+                if not self.index[gram]:
+                    del self.index[gram]
+
+    def trim(self, max_examples: int) -> list:
+        removed = []
+        while len(self.examples) > max_examples:
+            description = next(iter(self.examples))
+            self.remove(description)
+            removed.append(description)
+        return removed
+
+class CategoryClassifier:
+    """
+    Per-user k-nearest-neighbour category classifier over character n-grams of
+    expense descriptions. Each user keeps their last `max_examples` distinct
+    descriptions with the category they ended up with, so a manual fix simply
+    replaces the example. Examples are stored in the expense database, shared
+    by the bot and web processes; an in-memory LRU of users holds each model
+    with the version it was loaded at, and load() reloads a user whose version
+    moved because another process taught them something.
+
+    load(), learn() and train() take one of the awaitable databases from
+    create_async_database(); classify() and predict() only read memory, so
+    load the user first. New expenses and fixes are taught in the same
+    transaction that saves them, and remember() mirrors that in memory.
+    """
+
+    def __init__(self, max_examples: int = CLASSIFIER_MAX_EXAMPLES,
+                 min_confidence: float = CLASSIFIER_MIN_CONFIDENCE, cache_users: int = CLASSIFIER_CACHE_USERS):
+        self.max_examples = max_examples
+        self.min_confidence = min_confidence
+        self.cache_users = cache_users
+        self.hits = 0
+        self.misses = 0
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cache(self, user_id: int, model: _UserModel):
+        with self._lock:
+            self._models[user_id] = model
+            self._models.move_to_end(user_id)
+            while len(self._models) > self.cache_users:
+                self._models.popitem(last=False)
+
+    async def load(self, db, user_id: int) -> _UserModel:
+        """The user's model, reloaded from the database only if their examples changed since it was cached."""
+        with self._lock:
+            model = self._models.get(user_id)
+        if model is not None and await db.get_category_version(user_id) == model.version:
+            with self._lock:
+                if user_id in self._models:
+                    self._models.move_to_end(user_id)
+            return model
+
+        version, trained, examples = await db.get_category_examples(user_id)
+        model = _UserModel(version, trained)
+        for description, category in examples:
+            model.add(description, category)
+        model.trim(self.max_examples)
+        self._cache(user_id, model)
+        return model
+
+    async def train(self, db, user_id: int, examples):
+        """Teaches (description, category) pairs in order, oldest first, and marks the user as trained."""
+        await self.learn(db, user_id, examples, trained=True)
+
+    async def learn(self, db, user_id: int, examples, trained: bool = False):
+        """Teaches (description, category) pairs in their own transaction, e.g. a user's history."""
+        with self._lock:
+            model = self._models.get(user_id)
+        if model is None:
+            model = await self.load(db, user_id)
+        examples = unique_examples(examples)
+        with self._lock:
+            for description, category in examples:
+                model.add(description, category)
+            trimmed = model.trim(self.max_examples)
+            taught = [(description, category) for description, category in examples
+                      if description in model.examples]
+        if not taught and not trained:
+            return
+
+        try:
+            version = await db.save_category_examples(
+                user_id, taught, keep=self.max_examples if trimmed else None, trained=trained
+            )
+        except Exception:
+            with self._lock:
+                if self._models.get(user_id) is model:
+                    del self._models[user_id]
+            raise
+
+        with self._lock:
+            if version == model.version + 1:
+                model.version = version
+                model.trained = model.trained or trained
+            elif self._models.get(user_id) is model:
+                # Another process wrote in between; load() picks up both changes
+                del self._models[user_id]
+
+    def remember(self, user_id: int, examples):
+        """
+        Mirrors examples a write has just stored along with its expenses (see
+        BaseDatabase.add_expense's learn), which bumped the user's version by one.
+        If anyone else wrote in between, load() sees a version past ours and reloads.
+        """
+        examples = unique_examples(examples)
+        if not examples:
+            return
+        with self._lock:
+            model = self._models.get(user_id)
+            if model is None:
+                return
+            for description, category in examples:
+                model.add(description, category)
+            model.trim(self.max_examples)
+            model.version += 1
+
+    def classify(self, user_id: int, description: str):
+        """
+        Returns (category, confidence) from the user's most similar past descriptions,
+        or None without a neighbour at CLASSIFIER_MIN_SIMILARITY (or without a loaded
+        model). Confidence is the similarity-weighted share of the CLASSIFIER_NEIGHBOURS
+        nearest that agree; a description the user has already categorized is answered
+        with certainty.
+        """
+        description = normalize_description(description)
+        grams = char_ngrams(description)
+        with self._lock:
+            model = self._models.get(user_id)
+            if model is None:
+                return None
+            if description in model.examples:
+                return model.examples[description][0], 1.0
+            overlaps = Counter()
+            for gram in grams:
+                overlaps.update(model.index.get(gram, ()))
+            neighbours = heapq.nlargest(CLASSIFIER_NEIGHBOURS, (
+                (overlap / math.sqrt(len(grams) * len(model.examples[example][1])), model.examples[example][0])
+                for example, overlap in overlaps.items()
+            ))
+
+        neighbours = [(similarity, category) for similarity, category in neighbours if similarity >= CLASSIFIER_MIN_SIMILARITY]
+        if not neighbours:
+            return None
+        votes = defaultdict(float)
+        for similarity, category in neighbours:
+            votes[category] += similarity
+        category, weight = max(votes.items(), key=lambda vote: vote[1])
+        return category, weight / sum(votes.values())
+
+    def predict(self, user_id: int, description: str):
+        """The user's category for description when the classifier is confident enough, else None."""
+        prediction = self.classify(user_id, description)
+        if prediction and prediction[1] >= self.min_confidence:
+            self.hits += 1
+            return prediction[0]
+        self.misses += 1
+        return None
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "users": len(self._models),
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+category_classifier = CategoryClassifier()
+
+def remember_expenses(user_id: int, expenses):
+    """
+    Mirrors the description and category of Expense rows just saved with learn=True:
+    new ones the analysis was confident about (see is_confident), or ones the user corrected.
+    """
+    category_classifier.remember(user_id, [(expense.description, expense.category) for expense in expenses if expense])
+
+async def train_from_history(db, user_id: int):
+    """
+    Loads the user's model before their message is analyzed, teaching it their
+    stored expenses the first time we see them.
+    """
+    model = await category_classifier.load(db, user_id)
+    if model.trained:
+        return
+    examples = []
+    async for chunk in db.iter_expenses(user_id):
+        examples.extend((description, category) for _, _, _, description, category, _ in chunk)
+        # Only the newest max_examples survive, so don't hold more than a window of them
+        del examples[:-category_classifier.max_examples]
+    await category_classifier.train(db, user_id, examples)
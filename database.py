@@ -1,60 +1,839 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Text
+from sqlalchemy import create_engine, event, text, select, tuple_, Column, Integer, BigInteger, String, Float, DateTime, Date, Text, Index, func
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from datetime import datetime
+from sqlalchemy.orm import sessionmaker, Session
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager, asynccontextmanager
+from datetime import datetime, time, timedelta
+import argparse
+import asyncio
+import os
+import threading
+from time import perf_counter
+
+from metrics import DB_QUERY_SECONDS
+from classifier import CLASSIFIER_MAX_EXAMPLES, unique_examples
 
 Base = declarative_base()
 
+DEFAULT_CATEGORY = 'other'
+DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///expenses.db')
+DATABASE_BACKEND = os.getenv('DATABASE_BACKEND', 'async')
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+CURSOR_DATE_FORMAT = '%Y%m%d%H%M%S%f'
+DASHBOARD_CACHE_SIZE = int(os.getenv('DASHBOARD_CACHE_SIZE', 1024))
+
 class Expense(Base):
     __tablename__ = 'expenses'
-    
+    __table_args__ = (
+        Index('ix_expenses_user_id_date', 'user_id', 'date'),
+    )
+
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer)
+    user_id = Column(BigInteger)
     amount = Column(Float)
     description = Column(Text)
     category = Column(String(100))
     date = Column(DateTime, default=datetime.now)
     raw_text = Column(Text)
 
-class Database:
+class DailyCategoryTotal(Base):
+    """Per-user, per-day, per-category rollup of expenses, kept in sync by every write."""
+    __tablename__ = 'daily_category_totals'
+
+    user_id = Column(BigInteger, primary_key=True)
+    day = Column(Date, primary_key=True)
+    category = Column(String(100), primary_key=True)
+    total = Column(Float, nullable=False, default=0)
+    count = Column(Integer, nullable=False, default=0)
+
+class UserVersion(Base):
+    """Per-user counter bumped in the same transaction as every write to that user's expenses."""
+    __tablename__ = 'user_versions'
+
+    user_id = Column(BigInteger, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+class ImportJob(Base):
+    """Progress of a statement import. rows_done is committed with each batch, so a rerun resumes after it."""
+    __tablename__ = 'import_jobs'
+
+    id = Column(String(64), primary_key=True)
+    user_id = Column(BigInteger, nullable=False)
+    filename = Column(String(255))
+    status = Column(String(20), nullable=False, default='running')
+    rows_done = Column(Integer, nullable=False, default=0)
+    rows_imported = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.now)
+    updated_at = Column(DateTime, default=datetime.now)
+
+class CategoryExample(Base):
+    """A description the user's category classifier learned from, with the category it ended up in."""
+    __tablename__ = 'category_examples'
+
+    user_id = Column(BigInteger, primary_key=True)
+    description = Column(Text, primary_key=True)
+    category = Column(String(100), nullable=False)
+    updated_at = Column(Float, nullable=False)
+
+class CategoryUser(Base):
+    """Per-user classifier state: version is bumped with every change to the user's examples."""
+    __tablename__ = 'category_users'
+
+    user_id = Column(BigInteger, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    trained_at = Column(DateTime)  # set once the user's expense history was taught
+
+class SchemaMigration(Base):
+    __tablename__ = 'schema_migrations'
+
+    version = Column(Integer, primary_key=True)
+    name = Column(String(200))
+    applied_at = Column(DateTime, default=datetime.now)
+
+def encode_cursor(expense) -> str:
+    """Page cursor pointing just after this expense in (date, id) order. Short enough for Telegram callback data."""
+    return f"{expense.date.strftime(CURSOR_DATE_FORMAT)}-{expense.id}"
+
+def decode_cursor(cursor: str):
+    """Returns the (date, id) a cursor points after. Raises ValueError for a malformed cursor."""
+    date, _, expense_id = cursor.partition('-')
+    return datetime.strptime(date, CURSOR_DATE_FORMAT), int(expense_id)
+
+def _insert_for(session):
+    """The dialect's INSERT construct, for ON CONFLICT upserts."""
+    return postgresql.insert if session.get_bind().dialect.name == 'postgresql' else sqlite.insert
+
+def _configure_sqlite(dbapi_connection, connection_record):
+    """WAL lets readers run alongside a writer; busy_timeout makes writers queue instead of failing."""
+    dbapi_connection.isolation_level = None  # let SQLAlchemy emit BEGIN itself, see _begin_sqlite
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+def _begin_sqlite(conn):
+    # Write units take the write lock up front so a read-then-write transaction
+    # can't fail halfway when another writer committed in between.
+    conn.exec_driver_sql("BEGIN IMMEDIATE" if conn.get_execution_options().get("write") else "BEGIN")
+
+def normalize_database_url(url: str) -> str:
+    """Accepts the postgres:// URLs hosting providers hand out and picks the psycopg2 driver."""
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    if url.startswith('postgresql://'):
+        url = 'postgresql+psycopg2://' + url[len('postgresql://'):]
+    return url
+
+def async_database_url(url: str) -> str:
+    """Same database, asyncio driver."""
+    url = normalize_database_url(url)
+    if url.startswith('sqlite://'):
+        return 'sqlite+aiosqlite://' + url[len('sqlite://'):]
+    if url.startswith('postgresql+psycopg2://'):
+        return 'postgresql+asyncpg://' + url[len('postgresql+psycopg2://'):]
+    return url
+
+def _is_memory_sqlite(url: str) -> bool:
+    """sqlite:// and :memory: databases, which SQLAlchemy serves from a single-connection pool."""
+    if not url.startswith('sqlite'):
+        return False
+    path = url.split('://', 1)[1]
+    return path in ('', '/') or ':memory:' in path or 'mode=memory' in path
+
+def _engine_options(url: str) -> dict:
+    options = {}
+    if not _is_memory_sqlite(url):
+        options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
+    if url.startswith('sqlite'):
+        if 'aiosqlite' not in url:
+            options["connect_args"] = {"check_same_thread": False}
+    else:
+        options.update(pool_pre_ping=True, pool_recycle=DB_POOL_RECYCLE)
+    return options
+
+def _configure_engine(engine):
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, "connect", _configure_sqlite)
+        event.listen(engine, "begin", _begin_sqlite)
+    return engine
+
+def _create_expenses(connection):
+    Expense.__table__.create(connection, checkfirst=True)
+
+def _create_expenses_user_date_index(connection):
+    for index in Expense.__table__.indexes:
+        index.create(connection, checkfirst=True)
+
+def _create_daily_category_totals(connection):
+    DailyCategoryTotal.__table__.create(connection, checkfirst=True)
+    session = Session(bind=connection)
+    BaseDatabase._rebuild_daily_totals(session, bump_versions=False)  # user_versions comes later
+    session.flush()
+    session.close()
+
+def _create_import_jobs(connection):
+    ImportJob.__table__.create(connection, checkfirst=True)
+
+def _create_user_versions(connection):
+    UserVersion.__table__.create(connection, checkfirst=True)
+
+def _create_category_examples(connection):
+    CategoryExample.__table__.create(connection, checkfirst=True)
+    CategoryUser.__table__.create(connection, checkfirst=True)
+
+# Append-only: each step runs once per database, in order, and is recorded in schema_migrations
+MIGRATIONS = [
+    (1, "create expenses", _create_expenses),
+    (2, "index expenses on (user_id, date)", _create_expenses_user_date_index),
+    (3, "create daily_category_totals", _create_daily_category_totals),
+    (4, "create import_jobs", _create_import_jobs),
+    (5, "create user_versions", _create_user_versions),
+    (6, "create category_examples and category_users", _create_category_examples),
+]
+
+def migrate(engine):
+    """Applies pending schema migrations. Returns the versions that were applied."""
+    SchemaMigration.__table__.create(engine, checkfirst=True)
+    applied = []
+    for version, name, step in MIGRATIONS:
+        with engine.begin() as connection:
+            if engine.dialect.name == 'postgresql':
+                # Serialize concurrent deploys of the web service and the bot worker
+                connection.execute(text("SELECT pg_advisory_xact_lock(727274)"))
+            done = connection.execute(
+                SchemaMigration.__table__.select().where(SchemaMigration.version == version)
+            ).first()
+            if done:
+                continue
+            step(connection)
+            connection.execute(SchemaMigration.__table__.insert().values(
+                version=version, name=name, applied_at=datetime.now()
+            ))
+            applied.append(version)
+    return applied
+
+class BaseDatabase(ABC):
+    """
+    The expense store API. Every method is one unit of work that runs a
+    function taking a session through `_run`; subclasses decide whether that
+    happens inline (Database), in a worker thread (ThreadedDatabase) or on
+    an asyncio driver (AsyncDatabase, whose methods are awaitables).
+    """
+
     def __init__(self):
-        self.engine = create_engine('sqlite:///expenses.db')
-        Base.metadata.create_all(self.engine)
-        Session = sessionmaker(bind=self.engine)
-        self.session = Session()
-    
-    def add_expense(self, user_id: int, amount: float, description: str, category: str, raw_text: str):
+        self._dashboard_cache = OrderedDict()
+        self._dashboard_lock = threading.Lock()
+
+    @abstractmethod
+    def _run(self, fn, *args, write: bool = False):
+        """Runs fn(session, *args) as one unit of work and returns its result."""
+
+    def add_expense(self, user_id: int, amount: float, description: str, category: str, raw_text: str,
+                    learn: bool = False):
+        """
+        Inserts an expense. With learn, its description and category also become
+        an example for the user's category classifier, in the same transaction.
+        """
+        return self._run(self._add_expense, user_id, amount, description, category, raw_text, learn, write=True)
+
+    def add_expenses(self, user_id: int, expenses: list, raw_text: str):
+        """
+        Inserts several expenses from one message, given as dicts with amount,
+        description and category (and optionally date, raw_text and learn, as in
+        add_expense), in a single transaction. Returns them in order.
+        """
+        return self._run(self._add_expenses, user_id, expenses, raw_text, write=True)
+
+    def start_import_job(self, job_id: str, user_id: int, filename: str = None) -> ImportJob:
+        """Returns the user's import job with this id, creating it if it doesn't exist yet."""
+        return self._run(self._start_import_job, job_id, user_id, filename, write=True)
+
+    def get_import_job(self, job_id: str, user_id: int = None) -> ImportJob:
+        return self._run(self._get_import_job, job_id, user_id)
+
+    def import_batch(self, job_id: str, expenses: list, rows_done: int, done: bool = False) -> ImportJob:
+        """
+        Inserts one batch of imported expenses and records how far into the file
+        the job got, in the same transaction. Returns the updated job.
+        """
+        return self._run(self._import_batch, job_id, expenses, rows_done, done, write=True)
+
+    def get_expense(self, expense_id: int, user_id: int = None) -> Expense:
+        return self._run(self._get_expense, expense_id, user_id)
+
+    def update_expense(self, expense_id: int, user_id: int = None, amount: float = None,
+                       description: str = None, category: str = None, raw_text: str = None,
+                       learn: bool = False) -> Expense:
+        """
+        Updates the given fields of an expense (None keeps the current value)
+        and moves its contribution in the daily rollup in the same transaction,
+        teaching the user's category classifier the result if `learn`.
+        Returns the updated expense, or None if it doesn't exist.
+        """
+        return self._run(self._update_expense, expense_id, user_id, amount, description, category, raw_text,
+                         learn, write=True)
+
+    def rebuild_daily_totals(self, user_id: int = None):
+        """Regenerates the daily rollup from the raw expenses table."""
+        return self._run(self._rebuild_daily_totals, user_id, write=True)
+
+    def get_expenses(self, user_id: int, start_date: datetime = None, end_date: datetime = None):
+        return self._run(self._get_expenses, user_id, start_date, end_date)
+
+    def get_expenses_page(self, user_id: int, start_date: datetime = None, end_date: datetime = None,
+                          category: str = None, limit: int = 50, cursor: str = None):
+        """
+        One page of expenses in (date, id) order, starting after `cursor`.
+        Returns (expenses, next_cursor); next_cursor is None on the last page.
+        """
+        after = decode_cursor(cursor) if cursor else None
+        return self._run(self._get_expenses_page, user_id, start_date, end_date, category, limit, after)
+
+    @abstractmethod
+    def iter_expenses(self, user_id: int, start_date: datetime = None, end_date: datetime = None,
+                      chunk_size: int = 1000):
+        """
+        Streams a user's expenses oldest first as lists of at most chunk_size rows
+        (id, date, amount, description, category, raw_text), read from a
+        server-side cursor so memory doesn't grow with history. A generator on
+        Database and an async generator on the awaitable databases.
+        """
+
+    @staticmethod
+    def _expense_rows_query(user_id: int, start_date: datetime = None, end_date: datetime = None,
+                            chunk_size: int = 1000):
+        query = select(Expense.id, Expense.date, Expense.amount, Expense.description,
+                       Expense.category, Expense.raw_text).where(Expense.user_id == user_id)
+        if start_date:
+            query = query.where(Expense.date >= start_date)
+        if end_date:
+            query = query.where(Expense.date <= end_date)
+        return query.order_by(Expense.date, Expense.id).execution_options(yield_per=chunk_size)
+
+    def get_user_version(self, user_id: int) -> int:
+        """The user's change counter: it goes up with every write to their expenses (0 if never written)."""
+        return self._run(self._get_user_version, user_id)
+
+    def get_category_version(self, user_id: int) -> int:
+        """The version of the user's category classifier examples (0 if they have none)."""
+        return self._run(self._get_category_version, user_id)
+
+    def get_category_examples(self, user_id: int):
+        """
+        The user's category classifier state as (version, trained, examples), with
+        examples the (description, category) pairs least recently taught first.
+        """
+        return self._run(self._get_category_examples, user_id)
+
+    def save_category_examples(self, user_id: int, examples: list, keep: int = None, trained: bool = False) -> int:
+        """
+        Upserts (description, category) examples as the user's most recently taught,
+        in order, drops all but the newest `keep` when given, marks the user as
+        trained if asked, and bumps their version, in one transaction. Returns the new version.
+        """
+        return self._run(self._save_category_examples, user_id, examples, keep, trained, write=True)
+
+    def get_dashboard_summary(self, user_id: int, start_date: datetime, recent_limit: int = 50):
+        """
+        Everything the dashboard shows for the period since start_date (a day
+        boundary): {"total", "count", "categories": {category: total}, "recent": [Expense]},
+        with recent holding the newest recent_limit expenses. Totals come from
+        the daily rollup. Results are cached per user until that user's next write.
+        """
+        return self._run(self._get_dashboard_summary, user_id, start_date, recent_limit)
+
+    def get_stats(self, user_id: int, start_date: datetime = None, end_date: datetime = None):
+        """
+        Sum of expenses per category. Whole days are read from the daily rollup;
+        only the partial days at the edges of the range touch raw expenses.
+        """
+        return self._run(self._stats, user_id, start_date, end_date)
+
+    def get_latest_expense(self, user_id: int) -> Expense:
+        """Get the most recent expense for a user."""
+        return self._run(self._get_latest_expense, user_id)
+
+    @classmethod
+    def _add_expense(cls, session, user_id: int, amount: float, description: str, category: str, raw_text: str,
+                     learn: bool = False):
         expense = Expense(
             user_id=user_id,
             amount=amount,
             description=description,
-            category=category,
+            category=category or DEFAULT_CATEGORY,
+            date=datetime.now(),
             raw_text=raw_text
         )
-        self.session.add(expense)
-        self.session.commit()
+        session.add(expense)
+        cls._apply_to_rollup(session, {(user_id, expense.date.date(), expense.category): [amount or 0, 1]})
+        if learn:
+            cls._learn_categories(session, user_id, [expense])
         return expense
-    
-    def get_expenses(self, user_id: int, start_date: datetime = None, end_date: datetime = None):
-        query = self.session.query(Expense).filter(Expense.user_id == user_id)
+
+    @classmethod
+    def _add_expenses(cls, session, user_id: int, expenses: list, raw_text: str):
+        now = datetime.now()
+        rows = [
+            Expense(
+                user_id=user_id,
+                amount=item["amount"],
+                description=item["description"],
+                category=item.get("category") or DEFAULT_CATEGORY,
+                date=item.get("date") or now,
+                raw_text=item.get("raw_text", raw_text)
+            )
+            for item in expenses
+        ]
+        session.add_all(rows)
+
+        deltas = {}
+        for expense in rows:
+            delta = deltas.setdefault((user_id, expense.date.date(), expense.category), [0, 0])
+            delta[0] += expense.amount or 0
+            delta[1] += 1
+        cls._apply_to_rollup(session, deltas)
+        cls._learn_categories(session, user_id, [expense for expense, item in zip(rows, expenses) if item.get("learn")])
+        return rows
+
+    @staticmethod
+    def _start_import_job(session, job_id: str, user_id: int, filename: str = None) -> ImportJob:
+        job = session.get(ImportJob, job_id)
+        if job is None:
+            job = ImportJob(id=job_id, user_id=user_id, filename=filename, status='running',
+                            rows_done=0, rows_imported=0, created_at=datetime.now(), updated_at=datetime.now())
+            session.add(job)
+        elif job.user_id != user_id:
+            raise ValueError(f"Import job {job_id} belongs to another user")
+        return job
+
+    @staticmethod
+    def _get_import_job(session, job_id: str, user_id: int = None) -> ImportJob:
+        query = session.query(ImportJob).filter(ImportJob.id == job_id)
+        if user_id is not None:
+            query = query.filter(ImportJob.user_id == user_id)
+        return query.first()
+
+    @classmethod
+    def _import_batch(cls, session, job_id: str, expenses: list, rows_done: int, done: bool = False) -> ImportJob:
+        job = session.get(ImportJob, job_id)
+        if expenses:
+            cls._add_expenses(session, job.user_id, expenses, None)
+        job.rows_done = max(job.rows_done, rows_done)
+        job.rows_imported += len(expenses)
+        job.status = 'done' if done else 'running'
+        job.updated_at = datetime.now()
+        return job
+
+    @staticmethod
+    def _get_expense(session, expense_id: int, user_id: int = None, for_update: bool = False) -> Expense:
+        query = session.query(Expense).filter(Expense.id == expense_id)
+        if user_id is not None:
+            query = query.filter(Expense.user_id == user_id)
+        if for_update:
+            query = query.with_for_update()
+        return query.first()
+
+    @classmethod
+    def _update_expense(cls, session, expense_id: int, user_id: int = None, amount: float = None,
+                        description: str = None, category: str = None, raw_text: str = None,
+                        learn: bool = False) -> Expense:
+        # Lock the row so a concurrent edit can't subtract the same old amount from the rollup
+        # (SQLite has no row locks; BEGIN IMMEDIATE already serializes writers there)
+        expense = cls._get_expense(session, expense_id, user_id, for_update=True)
+        if not expense:
+            return None
+
+        deltas = {(expense.user_id, expense.date.date(), expense.category): [-(expense.amount or 0), -1]}
+        if amount is not None:
+            expense.amount = amount
+        if description is not None:
+            expense.description = description
+        if category is not None:
+            expense.category = category
+        if raw_text is not None:
+            expense.raw_text = raw_text
+
+        key = (expense.user_id, expense.date.date(), expense.category)
+        delta = deltas.setdefault(key, [0, 0])
+        delta[0] += expense.amount or 0
+        delta[1] += 1
+
+        cls._apply_to_rollup(session, deltas)
+        if learn:
+            cls._learn_categories(session, expense.user_id, [expense])
+        return expense
+
+    @staticmethod
+    def _bump_versions(session, user_ids):
+        insert = _insert_for(session)
+        versions = UserVersion.__table__
+        for user_id in sorted(user_ids):
+            session.execute(insert(versions).values(user_id=user_id, version=1).on_conflict_do_update(
+                index_elements=[versions.c.user_id],
+                set_={"version": versions.c.version + 1}
+            ))
+
+    @classmethod
+    def _apply_to_rollup(cls, session, deltas: dict):
+        """
+        Adds {(user_id, day, category): [amount, count]} deltas to the rollup in the
+        session's transaction and bumps each affected user's version. Increments
+        happen in SQL so concurrent writers don't lose each other's updates.
+        """
+        cls._bump_versions(session, {user_id for user_id, _, _ in deltas})
+
+        insert = _insert_for(session)
+        table = DailyCategoryTotal.__table__
+        for (user_id, day, category), (amount, count) in deltas.items():
+            if not amount and not count:
+                continue
+            statement = insert(table).values(user_id=user_id, day=day, category=category, total=amount, count=count)
+            session.execute(statement.on_conflict_do_update(
+                index_elements=[table.c.user_id, table.c.day, table.c.category],
+                set_={"total": table.c.total + amount, "count": table.c.count + count}
+            ))
+            if count < 0:
+                session.execute(table.delete().where(
+                    table.c.user_id == user_id, table.c.day == day,
+                    table.c.category == category, table.c.count <= 0
+                ))
+
+    @classmethod
+    def _rebuild_daily_totals(cls, session, user_id: int = None, bump_versions: bool = True):
+        deltas = {}
+        rows = session.query(Expense.user_id, Expense.date, Expense.category, Expense.amount)
+        totals = session.query(DailyCategoryTotal)
+        if user_id is not None:
+            rows = rows.filter(Expense.user_id == user_id)
+            totals = totals.filter(DailyCategoryTotal.user_id == user_id)
+
+        for row_user_id, date, category, amount in rows.yield_per(1000):
+            delta = deltas.setdefault((row_user_id, date.date(), category or DEFAULT_CATEGORY), [0, 0])
+            delta[0] += amount or 0
+            delta[1] += 1
+
+        totals.delete(synchronize_session=False)
+        session.add_all(
+            DailyCategoryTotal(user_id=key[0], day=key[1], category=key[2], total=total, count=count)
+            for key, (total, count) in deltas.items()
+        )
+        if bump_versions:
+            users = {key[0] for key in deltas}
+            cls._bump_versions(session, users | {user_id} if user_id is not None else users)
+        return len(deltas)
+
+    @staticmethod
+    def _get_expenses(session, user_id: int, start_date: datetime = None, end_date: datetime = None):
+        query = session.query(Expense).filter(Expense.user_id == user_id)
         if start_date:
             query = query.filter(Expense.date >= start_date)
         if end_date:
             query = query.filter(Expense.date <= end_date)
-        return query.all()
-    
-    def get_stats(self, user_id: int, start_date: datetime = None, end_date: datetime = None):
-        expenses = self.get_expenses(user_id, start_date, end_date)
+        return query.order_by(Expense.date).all()
+
+    @staticmethod
+    def _get_expenses_page(session, user_id: int, start_date: datetime = None, end_date: datetime = None,
+                           category: str = None, limit: int = 50, after: tuple = None):
+        query = session.query(Expense).filter(Expense.user_id == user_id)
+        if start_date:
+            query = query.filter(Expense.date >= start_date)
+        if end_date:
+            query = query.filter(Expense.date <= end_date)
+        if category:
+            query = query.filter(Expense.category == category)
+        if after:
+            # Keyset seek: served by the (user_id, date) index however deep the page is
+            query = query.filter(tuple_(Expense.date, Expense.id) > tuple_(*after))
+
+        expenses = query.order_by(Expense.date, Expense.id).limit(limit + 1).all()
+        if len(expenses) > limit:
+            return expenses[:limit], encode_cursor(expenses[limit - 1])
+        return expenses, None
+
+    @staticmethod
+    def _get_user_version(session, user_id: int) -> int:
+        version = session.query(UserVersion.version).filter(UserVersion.user_id == user_id).scalar()
+        return version or 0
+
+    @staticmethod
+    def _get_category_version(session, user_id: int) -> int:
+        version = session.query(CategoryUser.version).filter(CategoryUser.user_id == user_id).scalar()
+        return version or 0
+
+    @staticmethod
+    def _get_category_examples(session, user_id: int):
+        state = session.get(CategoryUser, user_id)
+        examples = session.query(CategoryExample.description, CategoryExample.category)\
+            .filter(CategoryExample.user_id == user_id)\
+            .order_by(CategoryExample.updated_at)\
+            .all()
+        examples = [tuple(example) for example in examples]
+        if state is None:
+            return 0, False, examples
+        return state.version, state.trained_at is not None, examples
+
+    @classmethod
+    def _learn_categories(cls, session, user_id: int, expenses: list):
+        """Adds expenses as the user's newest classifier examples (see CategoryClassifier.remember)."""
+        examples = unique_examples((expense.description, expense.category) for expense in expenses)
+        if examples:
+            cls._save_category_examples(session, user_id, examples, keep=CLASSIFIER_MAX_EXAMPLES)
+
+    @staticmethod
+    def _save_category_examples(session, user_id: int, examples: list, keep: int = None, trained: bool = False) -> int:
+        insert = _insert_for(session)
+        table = CategoryExample.__table__
+        now = datetime.now()
+        if examples:
+            # Later examples sort after earlier ones even within the same clock tick
+            statement = insert(table).values([
+                {"user_id": user_id, "description": description, "category": category,
+                 "updated_at": now.timestamp() + index * 1e-6}
+                for index, (description, category) in enumerate(examples)
+            ])
+            session.execute(statement.on_conflict_do_update(
+                index_elements=[table.c.user_id, table.c.description],
+                set_={"category": statement.excluded.category, "updated_at": statement.excluded.updated_at}
+            ))
+        if keep is not None and session.query(func.count(CategoryExample.description))\
+                .filter(CategoryExample.user_id == user_id).scalar() > keep:
+            newest = select(table.c.description).where(table.c.user_id == user_id)\
+                .order_by(table.c.updated_at.desc()).limit(keep)
+            session.execute(table.delete().where(table.c.user_id == user_id, table.c.description.not_in(newest)))
+
+        users = CategoryUser.__table__
+        values = {"user_id": user_id, "version": 1, "trained_at": now if trained else None}
+        updates = {"version": users.c.version + 1}
+        if trained:
+            updates["trained_at"] = now
+        session.execute(insert(users).values(**values).on_conflict_do_update(
+            index_elements=[users.c.user_id], set_=updates
+        ))
+        return session.query(CategoryUser.version).filter(CategoryUser.user_id == user_id).scalar()
+
+    def _get_dashboard_summary(self, session, user_id: int, start_date: datetime, recent_limit: int = 50):
+        # Checked against the version stored in the database, so writes made by
+        # another process (the bot worker) invalidate this process' cache too
+        version = self._get_user_version(session, user_id)
+        key = (version, start_date, recent_limit)
+        with self._dashboard_lock:
+            cached = self._dashboard_cache.get(user_id)
+            if cached and cached[0] == key:
+                self._dashboard_cache.move_to_end(user_id)
+                return cached[1]
+
+        rows = session.query(
+            DailyCategoryTotal.category,
+            func.sum(DailyCategoryTotal.total),
+            func.sum(DailyCategoryTotal.count)
+        ).filter(
+            DailyCategoryTotal.user_id == user_id,
+            DailyCategoryTotal.day >= start_date.date()
+        ).group_by(DailyCategoryTotal.category).all()
+
+        recent = session.query(Expense)\
+            .filter(Expense.user_id == user_id, Expense.date >= start_date)\
+            .order_by(Expense.date.desc(), Expense.id.desc())\
+            .limit(recent_limit)\
+            .all()
+
+        summary = {
+            "total": sum(total for _, total, _ in rows),
+            "count": sum(count for _, _, count in rows),
+            "categories": {category: total for category, total, _ in rows},
+            "recent": recent
+        }
+        with self._dashboard_lock:
+            self._dashboard_cache[user_id] = (key, summary)
+            self._dashboard_cache.move_to_end(user_id)
+            while len(self._dashboard_cache) > DASHBOARD_CACHE_SIZE:
+                self._dashboard_cache.popitem(last=False)
+        return summary
+
+    @classmethod
+    def _stats(cls, session, user_id: int, start_date: datetime = None, end_date: datetime = None):
+        first_day = None
+        if start_date:
+            first_day = start_date.date() if start_date.time() == time.min else start_date.date() + timedelta(days=1)
+        end_day = end_date.date() if end_date else None
+
+        if first_day and end_day and first_day >= end_day:
+            return cls._raw_stats(session, user_id, start_date, end_date)
+
+        query = session.query(DailyCategoryTotal.category, func.sum(DailyCategoryTotal.total))\
+            .filter(DailyCategoryTotal.user_id == user_id)
+        if first_day:
+            query = query.filter(DailyCategoryTotal.day >= first_day)
+        if end_day:
+            query = query.filter(DailyCategoryTotal.day < end_day)
+        stats = {category: total for category, total in query.group_by(DailyCategoryTotal.category).all()}
+
+        edges = []
+        if start_date and start_date.time() != time.min:
+            edges.append(cls._raw_stats(session, user_id, start_date, datetime.combine(first_day, time.min), inclusive=False))
+        if end_date:
+            edges.append(cls._raw_stats(session, user_id, datetime.combine(end_day, time.min), end_date))
+        for edge in edges:
+            for category, total in edge.items():
+                stats[category] = stats.get(category, 0) + total
+        return stats
+
+    @staticmethod
+    def _raw_stats(session, user_id: int, start_date: datetime = None, end_date: datetime = None, inclusive: bool = True):
+        """Sum of expenses per category, aggregated in SQL over raw rows."""
+        query = session.query(Expense.category, func.sum(Expense.amount))\
+            .filter(Expense.user_id == user_id)
+        if start_date:
+            query = query.filter(Expense.date >= start_date)
+        if end_date:
+            query = query.filter(Expense.date <= end_date if inclusive else Expense.date < end_date)
+        # Legacy rows without a category count as DEFAULT_CATEGORY, as they do in the rollup
         stats = {}
-        for expense in expenses:
-            if expense.category not in stats:
-                stats[expense.category] = 0
-            stats[expense.category] += expense.amount
+        for category, total in query.group_by(Expense.category).all():
+            stats[category or DEFAULT_CATEGORY] = stats.get(category or DEFAULT_CATEGORY, 0) + total
         return stats
 
-    def get_latest_expense(self, user_id: int) -> Expense:
-        """Get the most recent expense for a user."""
-        return self.session.query(Expense)\
+    @staticmethod
+    def _get_latest_expense(session, user_id: int) -> Expense:
+        return session.query(Expense)\
             .filter_by(user_id=user_id)\
-            .order_by(Expense.date.desc())\
-            .first() 
\ No newline at end of file
+            .order_by(Expense.date.desc(), Expense.id.desc())\
+            .first()
+
+class Database(BaseDatabase):
+    def __init__(self, url: str = None):
+        super().__init__()
+        url = normalize_database_url(url or DATABASE_URL)
+        self.engine = _configure_engine(create_engine(url, **_engine_options(url)))
+        migrate(self.engine)
+        self.Session = sessionmaker(bind=self.engine, expire_on_commit=False)
+
+    @contextmanager
+    def session_scope(self, write: bool = False):
+        """
+        One session and transaction per unit of work: commits on success and
+        rolls back on error. Objects stay readable after the session closes.
+        """
+        session = self.Session()
+        if write:
+            session.connection(execution_options={"write": True})
+        try:
+            yield session
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def _run(self, fn, *args, write: bool = False):
+        start = perf_counter()
+        try:
+            with self.session_scope(write=write) as session:
+                return fn(session, *args)
+        finally:
+            DB_QUERY_SECONDS.observe(perf_counter() - start, method=fn.__name__.lstrip('_'))
+
+    def iter_expenses(self, user_id: int, start_date: datetime = None, end_date: datetime = None,
+                      chunk_size: int = 1000):
+        with self.session_scope() as session:
+            result = session.execute(self._expense_rows_query(user_id, start_date, end_date, chunk_size))
+            yield from result.partitions()
+
+class ThreadedDatabase(Database):
+    """Database whose methods are awaitables running the blocking driver in a worker thread."""
+
+    async def _run(self, fn, *args, write: bool = False):
+        return await asyncio.to_thread(Database._run, self, fn, *args, write=write)
+
+    async def iter_expenses(self, user_id: int, start_date: datetime = None, end_date: datetime = None,
+                            chunk_size: int = 1000):
+        chunks = Database.iter_expenses(self, user_id, start_date, end_date, chunk_size)
+        try:
+            while True:
+                chunk = await asyncio.to_thread(next, chunks, None)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            await asyncio.to_thread(chunks.close)
+
+class AsyncDatabase(BaseDatabase):
+    """Database whose methods are awaitables on SQLAlchemy's asyncio extension over aiosqlite."""
+
+    def __init__(self, url: str = None):
+        from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+        super().__init__()
+        # Schema migrations run once, synchronously, at startup
+        url = url or DATABASE_URL
+        Database(url).engine.dispose()
+
+        url = async_database_url(url)
+        self.engine = create_async_engine(url, **_engine_options(url))
+        _configure_engine(self.engine.sync_engine)
+        self.Session = async_sessionmaker(bind=self.engine, expire_on_commit=False)
+
+    @asynccontextmanager
+    async def session_scope(self, write: bool = False):
+        """Async counterpart of Database.session_scope."""
+        async with self.Session() as session:
+            if write:
+                await session.connection(execution_options={"write": True})
+            try:
+                yield session
+                await session.commit()
+            except Exception:
+                await session.rollback()
+                raise
+
+    async def _run(self, fn, *args, write: bool = False):
+        start = perf_counter()
+        try:
+            async with self.session_scope(write=write) as session:
+                return await session.run_sync(fn, *args)
+        finally:
+            DB_QUERY_SECONDS.observe(perf_counter() - start, method=fn.__name__.lstrip('_'))
+
+    async def iter_expenses(self, user_id: int, start_date: datetime = None, end_date: datetime = None,
+                            chunk_size: int = 1000):
+        async with self.session_scope() as session:
+            result = await session.stream(self._expense_rows_query(user_id, start_date, end_date, chunk_size))
+            async for chunk in result.partitions():
+                yield chunk
+
+def create_async_database() -> BaseDatabase:
+    """
+    Database for async handlers, whose methods are all awaitables. DATABASE_BACKEND
+    picks 'async' (aiosqlite, the default) or 'thread' (blocking driver in a thread pool).
+    """
+    if DATABASE_BACKEND == 'thread':
+        return ThreadedDatabase()
+    if DATABASE_BACKEND == 'async':
+        return AsyncDatabase()
+    raise ValueError(f"Unknown DATABASE_BACKEND: {DATABASE_BACKEND}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Expense database maintenance")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rebuild = subparsers.add_parser("rebuild-rollup", help="Regenerate daily_category_totals from expenses")
+    rebuild.add_argument("--user-id", type=int, help="Only rebuild this user's rollup")
+    subparsers.add_parser("migrate", help="Apply pending schema migrations")
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        engine = create_engine(normalize_database_url(DATABASE_URL))
+        applied = migrate(engine)
+        print(f"Applied migrations: {applied or 'none'}")
+    elif args.command == "rebuild-rollup":
+        rows = Database().rebuild_daily_totals(args.user_id)
+        print(f"Rebuilt daily rollup: {rows} rows")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import os
+import asyncio
+from datetime import datetime
+
+EVENTS_QUEUE_SIZE = int(os.getenv('EVENTS_QUEUE_SIZE', 100))
+DASHBOARD_RECENT_LIMIT = int(os.getenv('DASHBOARD_RECENT_LIMIT', 50))
+
+class EventBroker:
+    """
+    In-process fan-out of per-user events to the dashboard's SSE streams.
+    Every open stream has its own bounded queue; one that falls behind gets a
+    single "resync" event instead of an unbounded backlog.
+    """
+
+    def __init__(self, queue_size: int = EVENTS_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers = {}
+
+    def subscribe(self, user_id: int) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.setdefault(user_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, user_id: int, queue: asyncio.Queue):
+        queues = self._subscribers.get(user_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[user_id]
+
+    def has_subscribers(self, user_id: int) -> bool:
+        return user_id in self._subscribers
+
+    def publish(self, user_id: int, event: dict):
+        for queue in self._subscribers.get(user_id, ()):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait({"type": "resync"})
+
+broker = EventBroker()
+
+def current_month_start() -> datetime:
+    return datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def expense_payload(expense) -> dict:
+    """The API's JSON shape of an expense."""
+    return {
+        "id": expense.id,
+        "amount": expense.amount,
+        "description": expense.description,
+        "category": expense.category,
+        "date": expense.date.strftime("%Y-%m-%d %H:%M:%S"),
+        "raw_text": expense.raw_text
+    }
+
+async def publish_expenses(db, user_id: int, action: str, expenses: list):
+    """
+    Tells the user's open dashboards that expenses were "created" or "updated",
+    along with the refreshed month totals. Does nothing when no dashboard is open.
+    """
+    if not expenses or not broker.has_subscribers(user_id):
+        return
+
+    # Also warms the dashboard cache for the next page load
+    start_date = current_month_start()
+    summary = await db.get_dashboard_summary(user_id, start_date, DASHBOARD_RECENT_LIMIT)
+    days_in_month = (datetime.now() - start_date).days + 1
+
+    broker.publish(user_id, {
+        "type": f"expenses.{action}",
+        "expenses": [expense_payload(expense) for expense in expenses],
+        "month": {
+            "total": summary["total"],
+            "count": summary["count"],
+            "avg_per_day": summary["total"] / days_in_month
+        }
+    })
+
+def publish_resync(user_id: int):
+    """Asks the user's open dashboards to reload, e.g. after a bulk import."""
+    broker.publish(user_id, {"type": "resync"})
@@ -0,0 +1,109 @@
+import io
+import os
+import csv
+import json
+from datetime import datetime
+
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 1000))
+EXPORT_FIELDS = ["id", "date", "amount", "description", "category", "raw_text"]
+EXPORT_FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "jsonl": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file that hands out what was written since the last take(), while keeping tell() absolute."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+def _row_values(row):
+    id, date, amount, description, category, raw_text = row
+    return [id, date.strftime(DATE_FORMAT) if date else None, amount, description, category, raw_text]
+
+async def _export_csv(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    yield ("\ufeff" + buffer.getvalue()).encode("utf-8")  # BOM so Excel reads Vietnamese correctly
+
+    async for chunk in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(_row_values(row) for row in chunk)
+        yield buffer.getvalue().encode("utf-8")
+
+async def _export_jsonl(chunks):
+    async for chunk in chunks:
+        yield "".join(
+            json.dumps(dict(zip(EXPORT_FIELDS, _row_values(row))), ensure_ascii=False) + "\n" for row in chunk
+        ).encode("utf-8")
+
+async def _export_parquet(chunks):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ("id", pa.int64()),
+        ("date", pa.timestamp("us")),
+        ("amount", pa.float64()),
+        ("description", pa.string()),
+        ("category", pa.string()),
+        ("raw_text", pa.string()),
+    ])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    try:
+        # One row group per chunk, flushed out as soon as it is written
+        async for chunk in chunks:
+            columns = zip(*chunk)
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema
+            ))
+            yield sink.take()
+    finally:
+        writer.close()
+    yield sink.take()
+
+_EXPORTERS = {"csv": _export_csv, "jsonl": _export_jsonl, "parquet": _export_parquet}
+
+def export_filename(format: str) -> str:
+    return f"expenses-{datetime.now().strftime('%Y%m%d')}.{format}"
+
+def export_expenses(db, user_id: int, format: str = "csv", start_date=None, end_date=None,
+                    chunk_size: int = EXPORT_CHUNK_SIZE):
+    """
+    Returns an async iterator of bytes with the user's expenses in the given
+    format, reading and writing chunk_size rows at a time. Raises ValueError for
+    an unknown format, or for parquet when pyarrow isn't installed.
+    """
+    if format not in _EXPORTERS:
+        raise ValueError(f"Unsupported export format: {format}. Use one of: {', '.join(EXPORT_FORMATS)}")
+    if format == "parquet":
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise ValueError("Parquet export needs pyarrow: pip install pyarrow")
+
+    return _EXPORTERS[format](db.iter_expenses(user_id, start_date, end_date, chunk_size))
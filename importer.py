@@ -0,0 +1,280 @@
+import os
+import re
+import csv
+import asyncio
+import hashlib
+import argparse
+import tempfile
+import unicodedata
+from datetime import datetime
+from itertools import chain, islice
+
+from llm import guess_category, categorize_descriptions_async
+from classifier import category_classifier, train_from_history
+
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', 1000))
+IMPORT_HEADER_SCAN_ROWS = 30
+IMPORT_SIGN_SCAN_ROWS = 200
+CSV_DELIMITERS = [",", ";", "\t"]
+
+# Header names used by common Vietnamese bank and e-wallet (MoMo, ZaloPay) exports
+COLUMN_ALIASES = {
+    "date": ["date", "ngày", "ngày giao dịch", "ngày gd", "thời gian", "thời gian giao dịch",
+             "transaction date", "ngày hiệu lực"],
+    "amount": ["amount", "số tiền", "số tiền giao dịch", "số tiền ghi nợ", "ghi nợ", "debit",
+               "phát sinh nợ", "số tiền (vnd)"],
+    "description": ["description", "mô tả", "nội dung", "nội dung giao dịch", "diễn giải",
+                    "chi tiết giao dịch", "details", "ghi chú"],
+    "credit": ["credit", "ghi có", "số tiền ghi có", "phát sinh có"],
+}
+# Statements without a separate credit column still import
+OPTIONAL_COLUMNS = {"credit"}
+# Amount columns that only hold money going out; any other amount column may be signed
+DEBIT_COLUMNS = {"số tiền ghi nợ", "ghi nợ", "debit", "phát sinh nợ"}
+
+DATE_FORMATS = [
+    "%d/%m/%Y %H:%M:%S", "%d/%m/%Y %H:%M", "%d/%m/%Y",
+    "%d-%m-%Y %H:%M:%S", "%d-%m-%Y",
+    "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d",
+]
+
+def _normalize_header(name: str) -> str:
+    return " ".join(unicodedata.normalize("NFC", name).lower().split())
+
+def find_columns(header: list):
+    """
+    Maps date/amount/description (and credit, when the statement has one) to
+    column indexes, or returns None if a required one is missing.
+    """
+    names = [_normalize_header(name) for name in header]
+    columns = {}
+    for field, aliases in COLUMN_ALIASES.items():
+        for alias in aliases:
+            if alias in names:
+                columns[field] = names.index(alias)
+                break
+        else:
+            if field in OPTIONAL_COLUMNS:
+                continue
+            return None
+    return columns
+
+def has_sign(value: str) -> bool:
+    """Whether an amount cell is written with an explicit sign: '+500', '-45,000', '45,000-' or '(45,000)'."""
+    value = (value or "").strip()
+    return value.startswith(("+", "-", "(")) or value.endswith("-")
+
+def parse_amount_cell(value: str):
+    """Parses '-45,000', '+1.200.000 VND', '(45,000)' or '45000.00' into a signed amount, or None."""
+    value = (value or "").strip()
+    negative = value.startswith("-") or value.endswith("-") or (value.startswith("(") and value.endswith(")"))
+    value = re.sub(r"[^\d.,]", "", value)
+    value = re.sub(r"[.,]\d{1,2}$", "", value)  # đồng amounts have no meaningful decimals
+    value = re.sub(r"[.,]", "", value)
+    if not value or not float(value):
+        return None
+    return -float(value) if negative else float(value)
+
+def spending_amount(amount_cell: str, signed: bool, debit_only: bool = False, credit_cell: str = None):
+    """
+    The money spent in one statement row, or None for a credit. Debit columns
+    hold spending whatever their sign. In a signed amount column only negative
+    amounts are spending; a row with anything in the credit column is income.
+    """
+    if credit_cell and parse_amount_cell(credit_cell):
+        return None
+    amount = parse_amount_cell(amount_cell)
+    if not amount:
+        return None
+    if debit_only or amount < 0:
+        return abs(amount)
+    return None if signed or has_sign(amount_cell) else amount
+
+def parse_date_cell(value: str):
+    value = (value or "").strip()
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+    return None
+
+def hash_stream(source, sink=None, chunk_size: int = 1 << 20):
+    """Reads a binary stream to the end, copying it into sink if given. Returns (size, sha256 digest)."""
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: source.read(chunk_size), b""):
+        digest.update(chunk)
+        size += len(chunk)
+        if sink is not None:
+            sink.write(chunk)
+    return size, digest.digest()
+
+def make_job_id(user_id: int, size: int, digest: bytes) -> str:
+    """
+    Job id for a file, from its whole content: the same user uploading the same
+    file again resumes the same job, while a newer export that only starts the
+    same way is a new job.
+    """
+    return hashlib.sha256(f"{user_id}\0{size}\0".encode() + digest).hexdigest()[:32]
+
+def spool_statement(source):
+    """
+    Copies a binary stream (e.g. an upload) into a real temporary file, so it
+    can be wrapped in io.TextIOWrapper on any Python, hashing it on the way.
+    Returns (file rewound to the start, size, sha256 digest).
+    """
+    spool = tempfile.TemporaryFile()
+    size, digest = hash_stream(source, spool)
+    spool.seek(0)
+    return spool, size, digest
+
+def iter_statement_rows(lines):
+    """
+    Reads a statement CSV from an iterable of text lines without loading it into
+    memory. Bank preamble rows above the header are skipped, and the delimiter
+    is whichever of CSV_DELIMITERS makes the header readable. Yields
+    (row_number, expense) for every data row, with expense None when the row
+    isn't a usable spending row, so row numbers stay stable across reruns.
+
+    Only money going out is imported. The amount column counts as signed when
+    any of its first IMPORT_SIGN_SCAN_ROWS cells carries a sign; then positive
+    rows are credits (salary, refunds, top-ups) and are skipped, as are rows
+    with an amount in a separate credit column.
+    """
+    lines = iter(lines)
+    head = list(islice(lines, IMPORT_HEADER_SCAN_ROWS))
+
+    # The header is the first row that names all three columns under some delimiter
+    columns = None
+    for delimiter in CSV_DELIMITERS:
+        for header_index, header in enumerate(csv.reader(head, delimiter=delimiter)):
+            columns = find_columns(header)
+            if columns:
+                break
+        if columns:
+            break
+    else:
+        raise ValueError("Không tìm thấy các cột ngày, số tiền và nội dung trong file CSV")
+
+    reader = csv.reader(chain(head, lines), delimiter=delimiter)
+    for _ in range(header_index + 1):
+        next(reader)
+
+    width = max(columns.values()) + 1
+    debit_only = _normalize_header(header[columns["amount"]]) in DEBIT_COLUMNS
+    lookahead = list(islice(reader, IMPORT_SIGN_SCAN_ROWS))
+    signed = any(has_sign(row[columns["amount"]]) for row in lookahead if len(row) >= width)
+
+    for row_number, row in enumerate(chain(lookahead, reader), 1):
+        expense = None
+        if len(row) >= width:
+            date = parse_date_cell(row[columns["date"]])
+            amount = spending_amount(
+                row[columns["amount"]], signed, debit_only,
+                row[columns["credit"]] if "credit" in columns else None
+            )
+            description = " ".join(row[columns["description"]].split())
+            if date and amount and description:
+                expense = {
+                    "date": date,
+                    "amount": amount,
+                    "description": description,
+                    "raw_text": ",".join(row)
+                }
+        yield row_number, expense
+
+def _batches(rows, size: int):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+async def categorize_expenses(expenses: list, known: dict, user_id: int = None):
+    """
+    Fills in "category": the user's own classifier and keyword rules first, then
+    one batched LLM request for the distinct descriptions that are left. `known`
+    remembers answers for the whole job.
+    """
+    pending = []
+    for expense in expenses:
+        description = expense["description"]
+        category = (known.get(description)
+                    or (user_id is not None and category_classifier.predict(user_id, description))
+                    or guess_category(description))
+        if category:
+            expense["category"] = category
+        elif description not in pending:
+            pending.append(description)
+
+    if pending:
+        for description, category in zip(pending, await categorize_descriptions_async(pending)):
+            known[description] = category or "other"
+
+    for expense in expenses:
+        expense.setdefault("category", known.get(expense["description"], "other"))
+
+def _progress(job):
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "rows_done": job.rows_done,
+        "rows_imported": job.rows_imported
+    }
+
+async def import_statement(db, user_id: int, lines, job_id: str, filename: str = None,
+                           batch_size: int = IMPORT_BATCH_SIZE):
+    """
+    Imports a statement CSV in batches of `batch_size` rows, one transaction per
+    batch, yielding a progress dict after each. Rows already imported by an
+    earlier run of the same job are skipped.
+    """
+    job = await db.start_import_job(job_id, user_id, filename)
+    if job.status == 'done':
+        yield _progress(job)
+        return
+
+    skip = job.rows_done
+    known = {}
+    await train_from_history(db, user_id)
+    for batch in _batches(iter_statement_rows(lines), batch_size):
+        rows_done = batch[-1][0]
+        if rows_done <= skip:
+            continue
+        expenses = [expense for row_number, expense in batch if expense and row_number > skip]
+        await categorize_expenses(expenses, known, user_id)
+        job = await db.import_batch(job_id, expenses, rows_done)
+        yield _progress(job)
+
+    job = await db.import_batch(job_id, [], job.rows_done, done=True)
+    yield _progress(job)
+
+async def _import_file(path: str, user_id: int, job_id: str = None, batch_size: int = IMPORT_BATCH_SIZE):
+    from database import create_async_database
+
+    db = create_async_database()
+    if not job_id:
+        with open(path, "rb") as file:
+            job_id = make_job_id(user_id, *hash_stream(file))
+
+    with open(path, encoding="utf-8-sig", errors="replace", newline="") as file:
+        async for progress in import_statement(db, user_id, file, job_id, os.path.basename(path), batch_size):
+            print(f"[{progress['job_id']}] {progress['status']}: "
+                  f"{progress['rows_done']} rows read, {progress['rows_imported']} expenses imported")
+
+def main():
+    parser = argparse.ArgumentParser(description="Import a bank or e-wallet CSV statement")
+    parser.add_argument("path", help="CSV file to import")
+    parser.add_argument("--user-id", type=int, required=True, help="Telegram user id that owns the expenses")
+    parser.add_argument("--job-id", help="Resume this job instead of the one derived from the file")
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE, help="Rows per transaction")
+    args = parser.parse_args()
+
+    asyncio.run(_import_file(args.path, args.user_id, args.job_id, args.batch_size))
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,378 @@
 import os
-from openai import OpenAI
+import asyncio
 from dotenv import load_dotenv
 import json
+import re
+import time
+import hashlib
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
 from enum import Enum
+from metrics import (
+    LLM_ANALYZE_SECONDS, LLM_ATTEMPTS, LLM_HEDGED_REQUESTS, LLM_CIRCUIT_OPEN, LLM_PROMPT_TOKENS, LLM_TOKENS
+)
+from resilience import CircuitBreaker, CircuitOpenError, LatencyTracker, backoff_delay
+from classifier import category_classifier
 
 load_dotenv()
 
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+_client = None
+_async_client = None
+
+def get_client():
+    """
+    The OpenAI client, created (and the openai package imported) on first use.
+    Its built-in retries are off; _complete and _complete_sync apply our own policy.
+    """
+    global _client
+    if _client is None:
+        from openai import OpenAI
+        _client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'), max_retries=0)
+    return _client
+
+def get_async_client():
+    global _async_client
+    if _async_client is None:
+        from openai import AsyncOpenAI
+        _async_client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'), max_retries=0)
+    return _async_client
 
 class MessageIntent(Enum):
     ADD_EXPENSE = "add_expense"
+    ADD_EXPENSES = "add_expenses"
     EDIT_EXPENSE = "edit_expense"
     GREETING = "greeting"
     QUESTION = "question"
     UNCLEAR = "unclear"
 
-def analyze_message(text: str, previous_expense=None):
+# Amount units, mirroring the rules in the system prompt below
+AMOUNT_MULTIPLIERS = {
+    "k": 1000, "nghìn": 1000, "nghin": 1000, "ngàn": 1000, "ngan": 1000,
+    "tr": 1000000, "triệu": 1000000, "trieu": 1000000,
+    "đồng": 1, "dong": 1, "đ": 1, "vnd": 1,
+}
+
+# Category keywords, mirroring the category list in the system prompt below
+CATEGORY_KEYWORDS = {
+    "food": ["ăn", "uống", "đồ ăn", "thức ăn", "cafe", "cà phê", "coffee", "trà sữa", "trà",
+             "nhà hàng", "phở", "bún", "cơm", "bánh mì", "bánh", "lẩu", "bia"],
+    "transport": ["di chuyển", "xăng", "đổ xăng", "grab", "taxi", "xe bus", "xe buýt", "bus",
+                  "gửi xe", "vé xe", "xe ôm"],
+    "shopping": ["mua sắm", "quần áo", "áo", "quần", "giày", "dép", "giày dép", "phụ kiện",
+                 "shopee", "lazada", "tiki"],
+    "entertainment": ["giải trí", "xem phim", "phim", "du lịch", "game", "karaoke", "netflix"],
+    "bills": ["hóa đơn", "tiền điện", "điện", "tiền nước", "internet", "wifi", "điện thoại",
+              "tiền nhà", "thuê nhà"],
+    "health": ["khám bệnh", "khám", "thuốc", "bảo hiểm", "y tế", "bệnh viện", "nha khoa"],
+    "education": ["học phí", "sách", "sách vở", "khóa học", "học"],
+}
+
+# Words that make a message look like an edit, a question or filler we can't judge locally
+EDIT_KEYWORDS = ["sửa", "đổi", "chỉnh", "thay", "cập nhật"]
+FILLER_WORDS = ["hôm nay", "sáng nay", "trưa nay", "chiều nay", "tối nay", "sáng", "trưa", "chiều", "tối",
+                "tôi", "mình", "chi", "tiêu", "hết", "mất", "tốn"]
+
+FAST_PATH_CONFIDENCE = 0.95
+FAST_PATH_MAX_LENGTH = 80
+FAST_PATH_MAX_EXPENSES = 10
+
+_AMOUNT_PATTERN = re.compile(
+    r"(?<![\w.,])(?P<number>\d+(?:[.,]\d+)*)\s*"
+    r"(?P<unit>" + "|".join(sorted(AMOUNT_MULTIPLIERS, key=len, reverse=True)) + r")?"
+    r"(?P<fraction>\d)?(?![\w.,])",
+    re.IGNORECASE
+)
+
+def _keyword_pattern(keywords):
+    return re.compile(r"(?<!\w)(?:" + "|".join(re.escape(k) for k in keywords) + r")(?!\w)")
+
+_CATEGORY_PATTERNS = {category: _keyword_pattern(words) for category, words in CATEGORY_KEYWORDS.items()}
+_EDIT_PATTERN = _keyword_pattern(EDIT_KEYWORDS)
+_FILLER_PATTERN = re.compile(r"^(?:(?:" + "|".join(re.escape(w) for w in FILLER_WORDS) + r")\s+)+")
+
+# "sáng phở 45k, trưa cơm 35k; tối cafe 30k" - commas inside amounts like 1,200,000 don't split
+_SEGMENT_SEPARATOR = re.compile(r"\s*(?:,(?!\d)|;|\n)\s*")
+
+fast_path_stats = {"hits": 0, "misses": 0}
+
+def _parse_number(raw: str):
+    """Parses '50', '1.5', '50.000' or '1,200,000'. Returns None when ambiguous."""
+    parts = re.split(r"[.,]", raw)
+    if len(parts) == 1:
+        return float(raw)
+    if all(len(part) == 3 for part in parts[1:]):
+        return float("".join(parts))
+    if len(parts) == 2:
+        return float(f"{parts[0]}.{parts[1]}")
+    return None
+
+def parse_amount(text: str):
     """
-    Analyze message intent and extract relevant information using LLM.
-    Returns a tuple of (intent, data).
+    Extracts a single amount from text like 'phở 50k' or 'đổ xăng 1tr5'.
+    Returns (amount, (start, end)) or None if there is no single unambiguous amount.
+    """
+    matches = list(_AMOUNT_PATTERN.finditer(text))
+    if len(matches) != 1:
+        return None
+
+    match = matches[0]
+    number = _parse_number(match.group("number"))
+    unit = (match.group("unit") or "").lower()
+    if number is None:
+        return None
+    if match.group("fraction"):
+        if unit not in ("k", "tr") or "." in match.group("number") or "," in match.group("number"):
+            return None
+        number += int(match.group("fraction")) / 10
+
+    amount = number * AMOUNT_MULTIPLIERS.get(unit, 1)
+    if not unit and amount < 1000:
+        return None  # "phở 50" - 50 đồng or 50k? Let the LLM decide
+
+    amount = round(amount / 1000) * 1000
+    if amount <= 0:
+        return None
+    return amount, match.span()
+
+def guess_category(text: str):
+    """Returns the single category whose keywords appear in text, or None."""
+    text = text.lower()
+    matched = [category for category, pattern in _CATEGORY_PATTERNS.items() if pattern.search(text)]
+    return matched[0] if len(matched) == 1 else None
+
+def fast_parse_message(text: str, previous_expense=None, categorize=None):
+    """
+    Deterministic parser for clear-cut expense messages like 'phở 50k', or lists of
+    them like 'sáng phở 45k, trưa cơm 35k'. categorize(description), when given,
+    is asked for the category before the keyword rules.
+    Returns (MessageIntent.ADD_EXPENSE, data), (MessageIntent.ADD_EXPENSES, data)
+    or None when the LLM should decide.
+    """
+    if previous_expense or not text:
+        return None
+
+    text = unicodedata.normalize("NFC", text).strip()
+    if "?" in text or _EDIT_PATTERN.search(text.lower()):
+        return None
+
+    segments = [segment for segment in _SEGMENT_SEPARATOR.split(text) if segment]
+    if 1 < len(segments) <= FAST_PATH_MAX_EXPENSES:
+        expenses = [_fast_parse_expense(segment, categorize) for segment in segments]
+        if all(expenses):
+            return MessageIntent.ADD_EXPENSES, {
+                "expenses": expenses,
+                "needs_clarification": False,
+                "clarification_question": ""
+            }
+
+    expense = _fast_parse_expense(text, categorize)
+    return (MessageIntent.ADD_EXPENSE, expense) if expense else None
+
+def _describe(text: str, start: int, end: int) -> str:
+    """The lowercased description around the amount at text[start:end], without filler words."""
+    description = f"{text[:start]} {text[end:]}"
+    description = _FILLER_PATTERN.sub("", " ".join(description.split()).lower())
+    return description.strip(" ,.;:-!")
+
+def _fast_parse_expense(text: str, categorize=None):
+    """Parses a single 'phở 50k' into add_expense data, or returns None."""
+    if len(text) > FAST_PATH_MAX_LENGTH:
+        return None
+
+    parsed = parse_amount(text)
+    if not parsed:
+        return None
+    amount, (start, end) = parsed
+
+    description = _describe(text, start, end)
+    if not description:
+        return None
+
+    category = (categorize and categorize(description)) or guess_category(description)
+    if not category:
+        return None
+
+    return {
+        "amount": amount,
+        "description": description[0].upper() + description[1:],
+        "category": category,
+        "confidence": FAST_PATH_CONFIDENCE,
+        "needs_clarification": False,
+        "clarification_question": ""
+    }
+
+def get_fast_path_stats():
+    """Returns how many messages the local parser answered without calling the LLM."""
+    total = fast_path_stats["hits"] + fast_path_stats["misses"]
+    return {
+        **fast_path_stats,
+        "hit_rate": fast_path_stats["hits"] / total if total else 0.0
+    }
+
+def normalize_message(text: str) -> str:
+    """Normalizes message text so trivially different spellings share a cache entry."""
+    text = unicodedata.normalize("NFC", text or "").lower()
+    return " ".join(text.split()).strip(" .!")
+
+LLM_CACHE_TTL = float(os.getenv('LLM_CACHE_TTL', 7 * 24 * 3600))
+
+class ResponseCache:
+    """
+    Cache of LLM results keyed on the normalized message and the edit context.
+    Entries live in an in-memory LRU and, when a path is given, in a SQLite file
+    so they survive restarts. Async callers use get_async() and set_nowait(),
+    which keep the SQLite reads and writes off the event loop.
     """
-    system_prompt = """Bạn là trợ lý phân tích tin nhắn cho bot quản lý chi tiêu. 
+
+    def __init__(self, max_size: int = 1024, ttl: float = LLM_CACHE_TTL, path: str = None, disk_max_size: int = 50000):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.disk_max_size = disk_max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self._writes = 0
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            # A lost cache write is harmless, so don't pay for a sync to disk on every commit
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, intent TEXT, data TEXT, expires_at REAL, last_used REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ix_llm_cache_last_used ON llm_cache (last_used)")
+            self._conn.commit()
+
+    @staticmethod
+    def make_key(text: str, previous_expense=None) -> str:
+        payload = json.dumps([normalize_message(text), previous_expense], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, text: str, previous_expense=None):
+        """Returns a cached (intent, data) tuple or None. Blocks on the disk cache after a memory miss."""
+        key = self.make_key(text, previous_expense)
+        now = time.time()
+        entry = self._lookup(key, now)
+        if entry is None and self._conn:
+            entry = self._load(key, now)
+        return self._result(entry)
+
+    async def get_async(self, text: str, previous_expense=None):
+        """get() for the event loop: only a memory miss waits, on the disk cache in a worker thread."""
+        key = self.make_key(text, previous_expense)
+        now = time.time()
+        entry = self._lookup(key, now)
+        if entry is None and self._conn:
+            entry = await asyncio.to_thread(self._load, key, now)
+        return self._result(entry)
+
+    def set(self, text: str, previous_expense, intent: MessageIntent, data: dict):
+        key, entry, now = self._entry(text, previous_expense, intent, data)
+        if self._conn:
+            self._store(key, entry, now)
+
+    def set_nowait(self, text: str, previous_expense, intent: MessageIntent, data: dict):
+        """set() for the event loop: remembers the result now and writes it to disk behind the caller's back."""
+        key, entry, now = self._entry(text, previous_expense, intent, data)
+        if self._conn:
+            asyncio.get_running_loop().run_in_executor(None, self._store_logged, key, entry, now)
+
+    def _entry(self, text: str, previous_expense, intent: MessageIntent, data: dict):
+        key = self.make_key(text, previous_expense)
+        now = time.time()
+        entry = (now + self.ttl, intent.value, json.dumps(data, ensure_ascii=False))
+        with self._lock:
+            self._remember(key, entry)
+        return key, entry, now
+
+    def _lookup(self, key: str, now: float):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] < now:
+                del self._entries[key]
+                entry = None
+            if entry:
+                self._entries.move_to_end(key)
+            return entry
+
+    def _load(self, key: str, now: float):
+        with self._disk_lock:
+            row = self._conn.execute(
+                "SELECT expires_at, intent, data FROM llm_cache WHERE key = ? AND expires_at >= ?",
+                (key, now)
+            ).fetchone()
+            if not row:
+                return None
+            self._conn.execute("UPDATE llm_cache SET last_used = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+        entry = tuple(row)
+        with self._lock:
+            self._remember(key, entry)
+        return entry
+
+    def _store(self, key: str, entry: tuple, now: float):
+        with self._disk_lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, intent, data, expires_at, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, *entry[1:], entry[0], now)
+            )
+            self._writes += 1
+            if self._writes % 100 == 0:
+                self._prune_disk(now)
+            self._conn.commit()
+
+    def _store_logged(self, key: str, entry: tuple, now: float):
+        try:
+            self._store(key, entry, now)
+        except Exception as e:
+            print(f"Error writing LLM cache: {e}")
+
+    def _result(self, entry):
+        with self._lock:
+            if not entry:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return MessageIntent(entry[1]), json.loads(entry[2])
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _prune_disk(self, now):
+        """Drops expired rows and the least recently used rows beyond disk_max_size."""
+        self._conn.execute("DELETE FROM llm_cache WHERE expires_at < ?", (now,))
+        self._conn.execute(
+            "DELETE FROM llm_cache WHERE key IN ("
+            "SELECT key FROM llm_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.disk_max_size,)
+        )
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+response_cache = ResponseCache(
+    max_size=int(os.getenv('LLM_CACHE_MAX_SIZE', 1024)),
+    ttl=LLM_CACHE_TTL,
+    path=os.getenv('LLM_CACHE_PATH', 'llm_cache.db') or None,
+    disk_max_size=int(os.getenv('LLM_CACHE_DISK_MAX_SIZE', 50000))
+)
+
+SYSTEM_PROMPT = """Bạn là trợ lý phân tích tin nhắn cho bot quản lý chi tiêu. 
 Nhiệm vụ của bạn là phân tích ý định và nội dung tin nhắn của người dùng.
 
 Các loại tin nhắn có thể có:
@@ -29,6 +381,7 @@ Các loại tin nhắn có thể có:
 3. Lời chào hoặc xã giao (greeting)
 4. Câu hỏi hoặc cần trợ giúp (question)
 5. Không rõ ý định (unclear)
+6. Ghi nhận nhiều chi tiêu trong một tin nhắn (add_expenses)
 
 Với mỗi loại tin nhắn, hãy trả về thông tin phù hợp theo định dạng JSON:
 
@@ -84,6 +437,24 @@ Với mỗi loại tin nhắn, hãy trả về thông tin phù hợp theo địn
     }
 }
 
+6. Ghi nhận nhiều chi tiêu (ví dụ: "sáng phở 45k, trưa cơm 35k, tối cafe 30k"):
+{
+    "intent": "add_expenses",
+    "data": {
+        "expenses": [
+            {
+                "amount": số tiền (hoặc null nếu không xác định được),
+                "description": "mô tả chi tiêu",
+                "category": "danh mục",
+                "confidence": 0.0 đến 1.0
+            }
+        ],
+        "needs_clarification": true/false,
+        "clarification_question": "câu hỏi làm rõ (nếu cần)"
+    }
+}
+Chỉ dùng add_expenses khi tin nhắn có từ hai khoản chi trở lên, mỗi khoản có số tiền riêng.
+
 Quy tắc xử lý:
 1. Số tiền:
    - Hỗ trợ đơn vị: k, nghìn, ngàn, triệu, tr, đồng, vnd, $
@@ -121,35 +492,582 @@ Quy tắc xử lý:
    - Tránh liệt kê các intent một cách máy móc
    - Luôn giữ giọng điệu thân thiện và lịch sự"""
 
+LLM_MODEL = os.getenv('LLM_MODEL', 'gpt-3.5-turbo')
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', 20))
+LLM_ATTEMPT_TIMEOUT = float(os.getenv('LLM_ATTEMPT_TIMEOUT', 8))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', 2))
+LLM_RETRY_BASE_DELAY = float(os.getenv('LLM_RETRY_BASE_DELAY', 0.5))
+LLM_RETRY_MAX_DELAY = float(os.getenv('LLM_RETRY_MAX_DELAY', 4))
+LLM_HEDGE_PERCENTILE = float(os.getenv('LLM_HEDGE_PERCENTILE', 0))
+LLM_BREAKER_ERROR_RATE = float(os.getenv('LLM_BREAKER_ERROR_RATE', 0.5))
+LLM_BREAKER_MIN_CALLS = int(os.getenv('LLM_BREAKER_MIN_CALLS', 10))
+LLM_BREAKER_WINDOW = float(os.getenv('LLM_BREAKER_WINDOW', 60))
+LLM_BREAKER_COOLDOWN = float(os.getenv('LLM_BREAKER_COOLDOWN', 30))
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', 8))
+LLM_BATCH_WINDOW_MS = float(os.getenv('LLM_BATCH_WINDOW_MS', 0))
+LLM_BATCH_MAX_SIZE = int(os.getenv('LLM_BATCH_MAX_SIZE', 16))
+LLM_COMPACT_PROMPTS = os.getenv('LLM_COMPACT_PROMPTS', '1') == '1'
+
+BATCH_PROMPT_SUFFIX = """
+
+Chế độ xử lý nhiều tin nhắn:
+- Bạn sẽ nhận một danh sách JSON các tin nhắn, mỗi tin nhắn có "id", "message" và có thể có "current_expense" (chi tiêu đang được chỉnh sửa).
+- Phân tích từng tin nhắn độc lập theo đúng các quy tắc trên.
+- Trả về đúng một kết quả cho mỗi tin nhắn theo định dạng JSON:
+{
+    "results": [
+        {"id": id của tin nhắn, "intent": "...", "data": {...}}
+    ]
+}"""
+
+CATEGORIES = list(CATEGORY_KEYWORDS) + ["other"]
+LLM_CATEGORIZE_BATCH_SIZE = int(os.getenv('LLM_CATEGORIZE_BATCH_SIZE', 100))
+
+CATEGORIZE_PROMPT = f"""Bạn phân loại các giao dịch trong sao kê ngân hàng/ví điện tử vào danh mục chi tiêu.
+Danh mục hợp lệ: {", ".join(CATEGORIES)}.
+Bạn sẽ nhận một danh sách JSON các nội dung giao dịch. Trả về đúng một danh mục cho mỗi nội dung, theo đúng thứ tự, theo định dạng JSON:
+{{"categories": ["danh mục", ...]}}
+Nếu không chắc chắn, dùng "other"."""
+
+# Compact prompts for messages whose intent is already narrowed down locally
+_COMPACT_RULES = """Số tiền: k/nghìn/ngàn ×1000, tr/triệu ×1000000, đồng/vnd ×1; làm tròn đến hàng nghìn.
+Danh mục: food (ăn uống, cafe, trà sữa, nhà hàng), transport (xăng, grab, taxi, xe bus, gửi xe), shopping (quần áo, giày dép, phụ kiện), entertainment (phim, du lịch, game), bills (điện, nước, internet, điện thoại), health (khám bệnh, thuốc, bảo hiểm), education (học phí, sách vở, khóa học), other.
+confidence từ 0.0 đến 1.0, dưới 0.7 khi không chắc chắn; khi đó có thể đặt needs_clarification=true kèm câu hỏi làm rõ thân thiện."""
+
+ADD_PROMPT = f"""Bạn phân tích tin nhắn ghi chi tiêu của bot quản lý chi tiêu và trả về JSON.
+Một khoản chi: {{"intent": "add_expense", "data": {{"amount": số tiền hoặc null, "description": "mô tả", "category": "danh mục", "confidence": số, "needs_clarification": true/false, "clarification_question": "câu hỏi hoặc chuỗi rỗng"}}}}
+Từ hai khoản trở lên, mỗi khoản có số tiền riêng: {{"intent": "add_expenses", "data": {{"expenses": [{{"amount": số tiền, "description": "mô tả", "category": "danh mục", "confidence": số}}], "needs_clarification": true/false, "clarification_question": "câu hỏi hoặc chuỗi rỗng"}}}}
+{_COMPACT_RULES}
+Nếu tin nhắn không phải ghi chi tiêu mới, chỉ trả về {{"intent": "unclear", "data": {{}}}}."""
+
+EDIT_PROMPT = f"""Bạn phân tích tin nhắn chỉnh sửa khoản chi tiêu gần nhất của bot quản lý chi tiêu và trả về JSON:
+{{"intent": "edit_expense", "data": {{"amount": số tiền mới hoặc null nếu giữ nguyên, "description": "mô tả mới" hoặc null nếu giữ nguyên, "category": "danh mục mới" hoặc null nếu giữ nguyên, "confidence": số, "needs_clarification": true/false, "clarification_question": "câu hỏi hoặc chuỗi rỗng"}}}}
+{_COMPACT_RULES}
+Nếu tin nhắn không phải chỉnh sửa chi tiêu, chỉ trả về {{"intent": "unclear", "data": {{}}}}."""
+
+PROMPTS = {"add": ADD_PROMPT, "edit": EDIT_PROMPT, "full": SYSTEM_PROMPT}
+
+FALLBACK_CONFIDENCE = 0.5
+FALLBACK_QUESTION = ("Xin lỗi, mình đang không hiểu được tin nhắn này. "
+                     "Bạn thử nhắn theo dạng [mô tả] [số tiền], ví dụ: Ăn phở 50k nhé.")
+# llm_analyze_seconds sources of answers given without the LLM because the call failed
+FAILED_SOURCES = ("circuit_open", "timeout", "unavailable", "error")
+
+_llm_semaphore = None
+_batcher = None
+
+# Shared by the sync and async paths, so an OpenAI incident seen by one fails fast in both
+circuit_breaker = CircuitBreaker(
+    LLM_BREAKER_ERROR_RATE, LLM_BREAKER_MIN_CALLS, LLM_BREAKER_WINDOW, LLM_BREAKER_COOLDOWN, name="openai"
+)
+llm_latencies = LatencyTracker()
+LLM_CIRCUIT_OPEN.set_function(lambda: int(circuit_breaker.is_open))
+
+def route_prompt(text: str, previous_expense=None) -> str:
+    """
+    Picks the smallest system prompt in PROMPTS that covers the message: "edit"
+    with an expense in context or an edit word, "add" for other messages with a
+    number in them, and "full" for everything else or when LLM_COMPACT_PROMPTS is off.
+    """
+    if not LLM_COMPACT_PROMPTS:
+        return "full"
+    text = unicodedata.normalize("NFC", text or "").lower()
+    if previous_expense or _EDIT_PATTERN.search(text):
+        return "edit"
+    if "?" not in text and re.search(r"\d", text):
+        return "add"
+    return "full"
+
+def _build_messages(text: str, previous_expense=None, prompt: str = "full"):
     user_prompt = f"Tin nhắn của người dùng: {text}"
     if previous_expense:
         user_prompt += f"\n\nChi tiêu hiện tại đang được chỉnh sửa:\n- Số tiền: {previous_expense['amount']}đ\n- Mô tả: {previous_expense['description']}\n- Danh mục: {previous_expense['category']}"
+    return [
+        {"role": "system", "content": PROMPTS[prompt]},
+        {"role": "user", "content": user_prompt}
+    ]
+
+def _record_usage(response, prompt: str):
+    """Token counts OpenAI reported for a completion, into llm_prompt_tokens and llm_tokens_total."""
+    usage = getattr(response, "usage", None)
+    if usage:
+        LLM_PROMPT_TOKENS.observe(usage.prompt_tokens, prompt=prompt)
+        LLM_TOKENS.inc(usage.prompt_tokens, prompt=prompt, kind="prompt")
+        LLM_TOKENS.inc(usage.completion_tokens, prompt=prompt, kind="completion")
+
+def _parse_response(response, prompt: str = "full"):
+    """
+    The (intent, data) in a completion, recording its token usage under `prompt`.
+    Returns None when a compact prompt answered "unclear", i.e. the message is
+    outside what that prompt covers and should be asked again with the full one.
+    """
+    _record_usage(response, prompt)
+    result = json.loads(response.choices[0].message.content)
+    intent = MessageIntent(result["intent"])
+    if prompt in ("add", "edit") and intent == MessageIntent.UNCLEAR:
+        return None
+    return intent, result["data"]
+
+def _unclear_result():
+    """The answer for a message the LLM call failed on for a reason retrying wouldn't fix, e.g. a malformed reply."""
+    return MessageIntent.UNCLEAR, {
+        "possible_intents": [],
+        "clarification_question": "Xin lỗi, tôi không hiểu ý của bạn. Bạn có thể nói rõ hơn được không?"
+    }
+
+def _fallback_result(text: str, previous_expense=None, categorize=None):
+    """
+    Best local answer when the LLM is unavailable. A message with a single amount
+    is taken as an edit (with edit words or context) or a new expense, with low
+    confidence so the user is told how to correct it. A new expense whose
+    category nobody recognises asks for the '[mô tả] [số tiền]' form instead of
+    being saved as "other", and so does anything else.
+    """
+    text = unicodedata.normalize("NFC", text or "").strip()
+    parsed = parse_amount(text) if "?" not in text else None
+    if parsed and (previous_expense or _EDIT_PATTERN.search(text.lower())):
+        return MessageIntent.EDIT_EXPENSE, {
+            "amount": parsed[0],
+            "description": None,
+            "category": None,
+            "confidence": FALLBACK_CONFIDENCE,
+            "needs_clarification": False,
+            "clarification_question": ""
+        }
+
+    description = _describe(text, *parsed[1]) if parsed else ""
+    category = description and ((categorize and categorize(description)) or guess_category(description))
+    if category:
+        return MessageIntent.ADD_EXPENSE, {
+            "amount": parsed[0],
+            "description": description[0].upper() + description[1:],
+            "category": category,
+            "confidence": FALLBACK_CONFIDENCE,
+            "needs_clarification": False,
+            "clarification_question": ""
+        }
+
+    return MessageIntent.UNCLEAR, {
+        "possible_intents": [],
+        "clarification_question": FALLBACK_QUESTION
+    }
+
+def _failure_result(error, text: str, previous_expense=None, categorize=None):
+    """
+    The answer when the LLM call raised: _fallback_result when OpenAI is
+    unavailable (open breaker, or timeouts, 429s and 5xx after retries),
+    _unclear_result for anything else. Returns (result, llm_analyze_seconds source).
+    """
+    if isinstance(error, CircuitOpenError):
+        return _fallback_result(text, previous_expense, categorize), "circuit_open"
+    outcome = _classify_error(error)
+    if outcome in RETRYABLE_OUTCOMES:
+        source = "timeout" if outcome == "timeout" else "unavailable"
+        return _fallback_result(text, previous_expense, categorize), source
+    return _unclear_result(), "error"
+
+def _personal_categorizer(user_id):
+    """The user's own category for a description from their history (classifier.py), or None for anonymous calls."""
+    if user_id is None:
+        return None
+    return lambda description: category_classifier.predict(user_id, description)
+
+def _personalize(result, categorize):
+    """Swaps in the user's own categories where their history is conclusive. Call after caching the shared result."""
+    intent, data = result
+    if categorize and intent in (MessageIntent.ADD_EXPENSE, MessageIntent.ADD_EXPENSES):
+        for expense in data.get("expenses", [data]):
+            category = expense.get("description") and categorize(expense["description"])
+            if category:
+                expense["category"] = category
+    return result
+
+def _fast_result(text: str, previous_expense=None, categorize=None):
+    """Answers from the local fast path as (result, source), or returns None."""
+    fast_result = fast_parse_message(text, previous_expense, categorize)
+    if fast_result:
+        fast_path_stats["hits"] += 1
+        return fast_result, "fast_path"
+    fast_path_stats["misses"] += 1
+    return None
+
+def _cached_result(cached, categorize=None):
+    """A response cache hit as (result, source), or None on a miss."""
+    return (_personalize(cached, categorize), "cache") if cached else None
+
+def _observe(start: float, result, source: str):
+    LLM_ANALYZE_SECONDS.observe(time.perf_counter() - start, intent=result[0].value, source=source)
+    return result
+
+def analyze_message(text: str, previous_expense=None, user_id: int = None):
+    """
+    Analyze message intent and extract relevant information using LLM.
+    Clear-cut expenses are answered by the local fast path and repeated messages
+    by the response cache, both without calling the LLM. OpenAI errors are retried
+    within LLM_TIMEOUT; if OpenAI stays unavailable, the answer comes from _fallback_result.
+    With a user_id, categories the user's history is confident about win.
+    Returns a tuple of (intent, data).
+    """
+    start = time.perf_counter()
+    categorize = _personal_categorizer(user_id)
+    local_result = (_fast_result(text, previous_expense, categorize)
+                    or _cached_result(response_cache.get(text, previous_expense), categorize))
+    if local_result:
+        return _observe(start, *local_result)
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            response_format={"type": "json_object"},
-            temperature=0.1
-        )
+        prompt = route_prompt(text, previous_expense)
+        result = _parse_response(_complete_sync(_build_messages(text, previous_expense, prompt)), prompt)
+        if result is None:
+            result = _parse_response(_complete_sync(_build_messages(text, previous_expense)))
         
-        result = json.loads(response.choices[0].message.content)
-        return MessageIntent(result["intent"]), result["data"]
+        intent, data = result
+        response_cache.set(text, previous_expense, intent, data)
+        return _observe(start, _personalize((intent, data), categorize), "llm")
         
     except Exception as e:
-        print(f"Error analyzing message: {e}")
-        return MessageIntent.UNCLEAR, {
-            "possible_intents": [],
-            "clarification_question": "Xin lỗi, tôi không hiểu ý của bạn. Bạn có thể nói rõ hơn được không?"
+        if not isinstance(e, CircuitOpenError):
+            print(f"Error analyzing message: {e}")
+        return _observe(start, *_failure_result(e, text, previous_expense, categorize))
+
+RETRYABLE_OUTCOMES = {"timeout", "rate_limited", "server_error"}
+
+def _classify_error(error) -> str:
+    """The llm_attempts outcome of a failed request. Only RETRYABLE_OUTCOMES count against the circuit breaker."""
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError)):
+        return "timeout"
+    import openai
+    if isinstance(error, openai.APITimeoutError):
+        return "timeout"
+    if isinstance(error, openai.RateLimitError):
+        return "rate_limited"
+    if isinstance(error, openai.APIConnectionError):
+        return "server_error"
+    if isinstance(error, openai.APIStatusError) and error.status_code >= 500:
+        return "server_error"
+    return "error"
+
+def _record_attempt(outcome: str, start: float = None, breaker: bool = True):
+    """Counts one request in llm_attempts and, unless breaker=False, reports its outcome to the circuit breaker."""
+    LLM_ATTEMPTS.inc(outcome=outcome)
+    if outcome == "ok":
+        llm_latencies.observe(time.perf_counter() - start)
+    if breaker:
+        _record_breaker(outcome)
+
+def _record_breaker(outcome: str):
+    if outcome == "ok":
+        circuit_breaker.record(True)
+    elif outcome in RETRYABLE_OUTCOMES:
+        circuit_breaker.record(False)
+
+def _retry_delay(attempt: int, error, deadline: float):
+    """
+    Seconds to wait before retrying after `error`, or None when it shouldn't be
+    retried: not a timeout/429/5xx, out of retries, or past the deadline.
+    A Retry-After header longer than the jittered backoff is honoured up to LLM_RETRY_MAX_DELAY.
+    """
+    if attempt >= LLM_MAX_RETRIES or _classify_error(error) not in RETRYABLE_OUTCOMES:
+        return None
+
+    delay = backoff_delay(attempt, LLM_RETRY_BASE_DELAY, LLM_RETRY_MAX_DELAY)
+    try:
+        delay = max(delay, min(float(error.response.headers["retry-after"]), LLM_RETRY_MAX_DELAY))
+    except (AttributeError, KeyError, TypeError, ValueError):
+        pass
+    return delay if time.perf_counter() + delay < deadline else None
+
+def _attempt_timeout(deadline: float) -> float:
+    remaining = deadline - time.perf_counter()
+    if remaining <= 0:
+        raise TimeoutError()  # the builtin, which the blocking path can raise too
+    return min(LLM_ATTEMPT_TIMEOUT, remaining)
+
+def _allow_attempt():
+    if not circuit_breaker.allow():
+        LLM_ATTEMPTS.inc(outcome="rejected")
+        raise CircuitOpenError("OpenAI circuit breaker is open")
+
+def _complete_sync(messages):
+    """Blocking _complete: the same deadline, retries and circuit breaker, without hedging."""
+    deadline = time.perf_counter() + LLM_TIMEOUT
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        _allow_attempt()
+        timeout = _attempt_timeout(deadline)
+        start = time.perf_counter()
+        try:
+            response = get_client().chat.completions.create(
+                model=LLM_MODEL,
+                messages=messages,
+                response_format={"type": "json_object"},
+                temperature=0.1,
+                timeout=timeout
+            )
+        except Exception as e:
+            _record_attempt(_classify_error(e))
+            delay = _retry_delay(attempt, e, deadline)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            continue
+        _record_attempt("ok", start)
+        return response
+
+async def _attempt(messages, deadline: float, breaker: bool = True):
+    """
+    One completion request, bounded by LLM_ATTEMPT_TIMEOUT and the deadline once it
+    has a concurrency slot. breaker=False leaves reporting the outcome to the caller.
+    """
+    global _llm_semaphore
+    if _llm_semaphore is None:
+        _llm_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+
+    async with _llm_semaphore:
+        timeout = _attempt_timeout(deadline)
+        start = time.perf_counter()
+        try:
+            response = await asyncio.wait_for(get_async_client().chat.completions.create(
+                model=LLM_MODEL,
+                messages=messages,
+                response_format={"type": "json_object"},
+                temperature=0.1
+            ), timeout=timeout)
+        except Exception as e:
+            _record_attempt(_classify_error(e), breaker=breaker)
+            raise
+        _record_attempt("ok", start, breaker=breaker)
+        return response
+
+async def _hedged_attempt(messages, deadline: float):
+    """
+    Runs _attempt, and if it is still waiting after the LLM_HEDGE_PERCENTILE latency
+    of recent calls, races an identical second request; the first answer wins and
+    the other request is cancelled. No hedging while the circuit breaker is open.
+    A hedged call reports one outcome to the breaker, however many requests it sent.
+    """
+    hedge_after = None
+    if LLM_HEDGE_PERCENTILE and not circuit_breaker.is_open:
+        hedge_after = llm_latencies.percentile(LLM_HEDGE_PERCENTILE)
+    if hedge_after is None:
+        return await _attempt(messages, deadline)
+
+    tasks = {asyncio.ensure_future(_attempt(messages, deadline, breaker=False))}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+        if not done:
+            LLM_HEDGED_REQUESTS.inc()
+            tasks.add(asyncio.ensure_future(_attempt(messages, deadline, breaker=False)))
+
+        error = None
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    _record_breaker("ok")
+                    return task.result()
+                error = task.exception()
+        _record_breaker(_classify_error(error))
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def _complete(messages, timeout: float = None):
+    """
+    One completion under the retry policy: timeouts, 429s and 5xx are retried up
+    to LLM_MAX_RETRIES times with jittered backoff, all within `timeout` seconds
+    (LLM_TIMEOUT by default). Raises CircuitOpenError without calling OpenAI
+    while the circuit breaker is open.
+    """
+    deadline = time.perf_counter() + (timeout or LLM_TIMEOUT)
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        _allow_attempt()
+        try:
+            return await _hedged_attempt(messages, deadline)
+        except Exception as e:
+            delay = _retry_delay(attempt, e, deadline)
+            if delay is None:
+                raise
+        await asyncio.sleep(delay)
+
+async def _analyze_remote(text: str, previous_expense=None):
+    prompt = route_prompt(text, previous_expense)
+    result = _parse_response(await _complete(_build_messages(text, previous_expense, prompt)), prompt)
+    if result is None:
+        result = _parse_response(await _complete(_build_messages(text, previous_expense)))
+    return result
+
+class MicroBatcher:
+    """
+    Collects concurrent analyze requests for up to `window` seconds or `max_size`
+    messages and sends them as one completion sharing a single system prompt.
+    """
+
+    def __init__(self, window: float, max_size: int):
+        self.window = window
+        self.max_size = max_size
+        self.batches = 0
+        self.messages = 0
+        self._pending = []
+        self._flush_handle = None
+        self._tasks = set()
+
+    async def submit(self, text: str, previous_expense=None):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, previous_expense, future))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._send(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch):
+        batch = [item for item in batch if not item[2].done()]
+        if not batch:
+            return
+        self.batches += 1
+        self.messages += len(batch)
+
+        results = {}
+        if len(batch) > 1:
+            try:
+                response = await _complete(self._build_messages(batch))
+                _record_usage(response, "batch")
+                for item in json.loads(response.choices[0].message.content)["results"]:
+                    results[int(item["id"])] = (MessageIntent(item["intent"]), item["data"])
+            except Exception as e:
+                print(f"Error analyzing message batch: {e}")
+
+        for index, (_, _, future) in enumerate(batch):
+            if index in results and not future.done():
+                future.set_result(results[index])
+
+        # Anything the batch didn't answer is retried on its own, all at once
+        await asyncio.gather(*(
+            self._retry(text, previous_expense, future)
+            for text, previous_expense, future in batch if not future.done()
+        ))
+
+    @staticmethod
+    async def _retry(text: str, previous_expense, future):
+        try:
+            result = await _analyze_remote(text, previous_expense)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return
+        if not future.done():
+            future.set_result(result)
+
+    @staticmethod
+    def _build_messages(batch):
+        items = []
+        for index, (text, previous_expense, _) in enumerate(batch):
+            item = {"id": index, "message": text}
+            if previous_expense:
+                item["current_expense"] = previous_expense
+            items.append(item)
+        return [
+            {"role": "system", "content": SYSTEM_PROMPT + BATCH_PROMPT_SUFFIX},
+            {"role": "user", "content": json.dumps(items, ensure_ascii=False)}
+        ]
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "messages": self.messages,
+            "avg_batch_size": self.messages / self.batches if self.batches else 0.0
         }
 
+def get_batcher():
+    """Returns the micro-batcher, or None when LLM_BATCH_WINDOW_MS is 0 (the default)."""
+    global _batcher
+    if _batcher is None and LLM_BATCH_WINDOW_MS > 0:
+        _batcher = MicroBatcher(LLM_BATCH_WINDOW_MS / 1000, LLM_BATCH_MAX_SIZE)
+    return _batcher
+
+async def analyze_message_async(text: str, previous_expense=None, user_id: int = None):
+    """
+    Non-blocking version of analyze_message for bot and web handlers.
+    At most LLM_MAX_CONCURRENCY requests are in flight at once, and each call,
+    including the wait for a free slot and any retries, is bounded by LLM_TIMEOUT
+    seconds. Slow requests can be hedged (LLM_HEDGE_PERCENTILE). When OpenAI is
+    unavailable or the circuit breaker is open, the answer comes from _fallback_result.
+    With LLM_BATCH_WINDOW_MS set, concurrent messages share one completion.
+    With a user_id, categories the user's history is confident about win.
+    """
+    start = time.perf_counter()
+    categorize = _personal_categorizer(user_id)
+    local_result = (_fast_result(text, previous_expense, categorize)
+                    or _cached_result(await response_cache.get_async(text, previous_expense), categorize))
+    if local_result:
+        return _observe(start, *local_result)
+
+    batcher = get_batcher()
+    if batcher:
+        request = batcher.submit(text, previous_expense)
+    else:
+        request = _analyze_remote(text, previous_expense)
+
+    try:
+        intent, data = await asyncio.wait_for(request, timeout=LLM_TIMEOUT)
+        response_cache.set_nowait(text, previous_expense, intent, data)
+        return _observe(start, _personalize((intent, data), categorize), "batch" if batcher else "llm")
+
+    except asyncio.TimeoutError as e:
+        print(f"Timed out analyzing message after {LLM_TIMEOUT}s")
+        return _observe(start, *_failure_result(e, text, previous_expense, categorize))
+    except Exception as e:
+        if not isinstance(e, CircuitOpenError):
+            print(f"Error analyzing message: {e}")
+        return _observe(start, *_failure_result(e, text, previous_expense, categorize))
+
+async def categorize_descriptions_async(descriptions: list):
+    """
+    Assigns a category to each transaction description with one completion per
+    LLM_CATEGORIZE_BATCH_SIZE descriptions. Returns a list aligned with
+    descriptions, with None where the LLM gave no usable answer.
+    """
+    categories = []
+    for start in range(0, len(descriptions), LLM_CATEGORIZE_BATCH_SIZE):
+        chunk = descriptions[start:start + LLM_CATEGORIZE_BATCH_SIZE]
+        answers = []
+        try:
+            response = await asyncio.wait_for(_complete([
+                {"role": "system", "content": CATEGORIZE_PROMPT},
+                {"role": "user", "content": json.dumps(chunk, ensure_ascii=False)}
+            ]), timeout=LLM_TIMEOUT)
+            _record_usage(response, "categorize")
+            answers = json.loads(response.choices[0].message.content)["categories"]
+        except Exception as e:
+            print(f"Error categorizing transactions: {e}")
+
+        if len(answers) != len(chunk):
+            answers = [None] * len(chunk)
+        categories.extend(answer if answer in CATEGORIES else None for answer in answers)
+    return categories
+
 def format_expense_message(expense_info, is_edit=False):
-    """Formats expense information into a user-friendly message."""
+    """
+    Formats expense information into a user-friendly message. Data with an
+    "expenses" list (add_expenses) gets one combined confirmation.
+    """
     if expense_info.get("needs_clarification"):
         return f"❓ {expense_info['clarification_question']}"
+
+    if "expenses" in expense_info:
+        return _format_expenses_message(expense_info["expenses"])
         
     action = "Đã ghi nhận lại" if is_edit else "Đã ghi nhận"
     confidence = expense_info.get("confidence", 1.0)
@@ -166,6 +1084,19 @@ def format_expense_message(expense_info, is_edit=False):
     
     return message
 
+def _format_expenses_message(expenses):
+    message = f"✅ Đã ghi nhận {len(expenses)} chi tiêu:\n"
+    for index, expense in enumerate(expenses, 1):
+        message += f"{index}. {expense['description']} - {format_amount(expense['amount'])}đ ({expense['category']})\n"
+    message += f"💰 Tổng cộng: {format_amount(sum(expense['amount'] or 0 for expense in expenses))}đ"
+
+    if any(expense.get("confidence", 1.0) < 0.7 for expense in expenses):
+        message += f"\n\n❓ Nếu thông tin trên không chính xác, bạn có thể chỉnh sửa khoản cuối cùng bằng cách nhắn:\n"
+        message += "- sửa thành [số tiền mới]\n"
+        message += "- đổi thành [mô tả mới] [số tiền]"
+
+    return message
+
 def format_amount(amount):
     """Formats amount with thousand separators."""
     return "{:,.0f}".format(amount) if amount else "0" 
\ No newline at end of file
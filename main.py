@@ -1,19 +1,24 @@
+import startup
+import metrics
 import multiprocessing
-import uvicorn
-from telegram.ext import ApplicationBuilder
-import os
 from dotenv import load_dotenv
-from web import app
-from bot import setup_bot
 
 load_dotenv()
 
 def run_web():
+    startup.begin()
+    import uvicorn
+    from web import app
+    startup.report("web")
     uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
 
 def run_telegram_bot():
-    application = ApplicationBuilder().token(os.getenv('TELEGRAM_BOT_TOKEN')).build()
-    setup_bot(application)
+    startup.begin()
+    from bot import build_application
+
+    application = build_application()
+    metrics.start_http_server()
+    startup.report("bot")
     application.run_polling(allowed_updates=["message", "callback_query"])
 
 def main():
@@ -0,0 +1,196 @@
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_registry = []
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+class _Metric:
+    """A metric family in the Prometheus text format. Safe to update from any thread."""
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for suffix, values, extra, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, values, extra)} {_format_value(value)}")
+        return "\n".join(lines)
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            return [("_total", key, (), value) for key, value in sorted(self._values.items())]
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, function):
+        """Reads the value from function() at scrape time (unlabelled gauges only)."""
+        self._function = function
+
+    def _samples(self):
+        if self._function is not None:
+            return [("", (), (), self._function())]
+        with self._lock:
+            return [("", key, (), value) for key, value in sorted(self._values.items())]
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def count(self, **labels) -> int:
+        """How many values were observed so far under labels including the given ones."""
+        wanted = [(self.labelnames.index(name), str(value)) for name, value in labels.items()]
+        with self._lock:
+            return sum(state[2] for key, state in self._values.items()
+                       if all(key[index] == value for index, value in wanted))
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes how long the with-block took, including awaits inside it."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    samples.append(("_bucket", key, [("le", _format_value(bound))], cumulative))
+                samples.append(("_sum", key, (), total))
+                samples.append(("_count", key, (), count))
+        return samples
+
+def render() -> str:
+    """All registered metrics in the Prometheus text exposition format."""
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_http_server(port: int = METRICS_PORT):
+    """Serves /metrics on its own port from a daemon thread, for processes without a web app (the bot worker)."""
+    if not port:
+        return None
+    server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Serving metrics on :{port}/metrics")
+    return server
+
+# Hot-path metrics shared by the bot, the web app and the database layer
+LLM_ANALYZE_SECONDS = Histogram(
+    "llm_analyze_seconds", "analyze_message latency by resulting intent and where the answer came from",
+    ["intent", "source"]
+)
+DB_QUERY_SECONDS = Histogram(
+    "db_query_seconds", "Time per Database method call, including waiting for a connection", ["method"]
+)
+TELEGRAM_HANDLER_SECONDS = Histogram(
+    "telegram_handler_seconds", "Telegram handler latency per command", ["command"]
+)
+CHART_RENDER_SECONDS = Histogram(
+    "chart_render_seconds", "Time to produce the /stats chart", ["cached"]
+)
+WEBHOOK_QUEUE_DEPTH = Gauge(
+    "webhook_queue_depth", "Webhook updates accepted but not processed yet"
+)
+LLM_ATTEMPTS = Counter(
+    "llm_attempts", "OpenAI requests by outcome (ok, timeout, rate_limited, server_error, error, rejected)", ["outcome"]
+)
+LLM_HEDGED_REQUESTS = Counter(
+    "llm_hedged_requests", "Second requests sent because the first was slower than LLM_HEDGE_PERCENTILE"
+)
+LLM_CIRCUIT_OPEN = Gauge(
+    "llm_circuit_open", "1 while the OpenAI circuit breaker rejects calls"
+)
+LLM_PROMPT_TOKENS = Histogram(
+    "llm_prompt_tokens", "Prompt tokens per OpenAI call by system prompt (add, edit, full, batch, categorize)",
+    ["prompt"], buckets=(100, 200, 400, 800, 1200, 1600, 2400, 3200, 6400, 12800)
+)
+LLM_TOKENS = Counter(
+    "llm_tokens", "Tokens reported by OpenAI by system prompt and kind (prompt, completion)", ["prompt", "kind"]
+)
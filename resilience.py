@@ -0,0 +1,97 @@
+import math
+import time
+import random
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency whose circuit breaker is open."""
+
+class CircuitBreaker:
+    """
+    Opens when at least `min_calls` calls in the last `window` seconds failed at
+    `error_rate` or more, and then rejects calls for `cooldown` seconds. After
+    that a single trial call is let through: its success closes the breaker,
+    its failure keeps it open for another cooldown. Safe to use from any thread.
+    """
+
+    def __init__(self, error_rate: float = 0.5, min_calls: int = 10, window: float = 60.0,
+                 cooldown: float = 30.0, name: str = "circuit"):
+        self.error_rate = error_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.cooldown = cooldown
+        self.name = name
+        self._results = deque()
+        self._opened_at = None
+        self._trial_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        """True while calls are being rejected or only a trial call is allowed."""
+        return self._opened_at is not None
+
+    def allow(self) -> bool:
+        """Whether a call may go out now. Call record() with its outcome afterwards."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - self._opened_at < self.cooldown:
+                return False
+            # A trial whose outcome never arrived (e.g. it was cancelled) doesn't block the next one forever
+            if self._trial_at is not None and now - self._trial_at < self.cooldown:
+                return False
+            self._trial_at = now
+            return True
+
+    def record(self, success: bool):
+        with self._lock:
+            now = time.monotonic()
+            if self._opened_at is not None:
+                if self._trial_at is None:
+                    return  # a call started before the breaker opened
+                self._trial_at = None
+                if success:
+                    logger.info(f"{self.name}: trial call succeeded, closing")
+                    self._opened_at = None
+                    self._results.clear()
+                else:
+                    self._opened_at = now
+                return
+
+            self._results.append((now, success))
+            while now - self._results[0][0] > self.window:
+                self._results.popleft()
+            failures = sum(not ok for _, ok in self._results)
+            if len(self._results) >= self.min_calls and failures / len(self._results) >= self.error_rate:
+                logger.warning(f"{self.name}: {failures}/{len(self._results)} calls failed, opening for {self.cooldown}s")
+                self._opened_at = now
+
+class LatencyTracker:
+    """The last `size` latencies of successful calls, for percentile-based decisions like hedging."""
+
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._values = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self._values.append(seconds)
+
+    def percentile(self, p: float):
+        """Nearest-rank percentile in seconds, or None until min_samples calls were seen."""
+        with self._lock:
+            if len(self._values) < self.min_samples:
+                return None
+            values = sorted(self._values)
+        return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Exponential backoff with full jitter: uniform over [0, min(cap, base * 2**attempt)]."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
@@ -1,24 +1,29 @@
-from telegram.ext import ApplicationBuilder
+import startup
+import metrics
 import os
 from dotenv import load_dotenv
-from bot import setup_bot
 
 load_dotenv()
 
 def main():
-    application = ApplicationBuilder().token(os.getenv('TELEGRAM_BOT_TOKEN')).build()
-    setup_bot(application)
-    
+    startup.begin()
+    from bot import build_application
+
+    application = build_application()
+    metrics.start_http_server()
+    startup.report("bot")
+
     # Set webhook
     webhook_url = os.getenv('WEBHOOK_URL', 'https://extracker-04hz.onrender.com/webhook')
     port = int(os.getenv('PORT', 8443))
-    
+
     application.run_webhook(
         listen='0.0.0.0',
         port=port,
         webhook_url=webhook_url,
+        secret_token=os.getenv('WEBHOOK_SECRET'),
         drop_pending_updates=True
     )
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
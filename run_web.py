@@ -1,5 +1,11 @@
-import uvicorn
-from web import app
- 
+import startup
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info") 
\ No newline at end of file
+    # Heavy imports stay under the main guard so worker processes spawned
+    # by the app (see charts.py) don't re-import the whole web stack.
+    startup.begin()
+    import uvicorn
+    from web import app
+    startup.report("web")
+
+    uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
@@ -0,0 +1,53 @@
+import os
+import sys
+import time
+import logging
+import builtins
+
+logger = logging.getLogger(__name__)
+
+STARTUP_PROFILE = os.getenv('STARTUP_PROFILE', '').lower() in ('1', 'true', 'yes')
+STARTUP_PROFILE_TOP = int(os.getenv('STARTUP_PROFILE_TOP', 15))
+
+_started_at = time.perf_counter()
+_original_import = builtins.__import__
+_import_times = {}
+_stack = []
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    package = name.partition('.')[0]
+    if level or package in sys.modules or package in _import_times:
+        return _original_import(name, globals, locals, fromlist, level)
+
+    _stack.append(0.0)
+    start = time.perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.perf_counter() - start
+        children = _stack.pop()
+        _import_times[package] = (elapsed, elapsed - children)
+        if _stack:
+            _stack[-1] += elapsed
+
+def begin():
+    """
+    Marks the start of process startup. With STARTUP_PROFILE=1 it also times the
+    first import of every top-level package until report() is called.
+    Import this module before anything heavy.
+    """
+    global _started_at
+    _started_at = time.perf_counter()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    if STARTUP_PROFILE:
+        builtins.__import__ = _timed_import
+
+def report(name: str):
+    """Logs how long startup took and, with STARTUP_PROFILE=1, the slowest imports."""
+    builtins.__import__ = _original_import
+    logger.info(f"{name} ready in {(time.perf_counter() - _started_at) * 1000:.0f} ms")
+
+    slowest = sorted(_import_times.items(), key=lambda item: item[1][0], reverse=True)
+    for package, (total, own) in slowest[:STARTUP_PROFILE_TOP]:
+        logger.info(f"  import {package}: {total * 1000:.1f} ms (self {own * 1000:.1f} ms)")
+    _import_times.clear()
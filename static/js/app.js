@@ -1,3 +1,5 @@
+let liveUpdates = false;
+
 document.addEventListener('DOMContentLoaded', () => {
     // Initialize date range picker
     $('#daterange').daterangepicker({
@@ -53,8 +55,11 @@ document.addEventListener('DOMContentLoaded', () => {
                     throw new Error('Failed to add expense');
                 }
                 
-                // Reload page to show new expense
-                window.location.reload();
+                // The live stream inserts the new row; reload only without it
+                expenseForm.reset();
+                if (!liveUpdates) {
+                    window.location.reload();
+                }
             } catch (error) {
                 console.error('Error:', error);
                 alert('Failed to add expense. Please try again.');
@@ -63,53 +68,117 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     // Handle inline editing
-    document.querySelectorAll('.editable, .editable-select').forEach(el => {
-        el.addEventListener('blur', async function() {
-            const expenseId = this.closest('tr').dataset.expenseId;
-            const field = this.dataset.field;
-            let value = this.tagName.toLowerCase() === 'select' ? this.value : this.textContent.trim();
+    document.querySelectorAll('.editable, .editable-select').forEach(bindEditable);
 
-            // Convert amount string to number
-            if (field === 'amount') {
-                value = parseFloat(value.replace(/[,.]/g, ''));
-            }
+    // Live updates: rows added or edited anywhere (web or Telegram) are patched in place
+    if (window.EventSource && document.getElementById('expense-rows')) {
+        const events = new EventSource('/api/events');
+        events.onopen = () => { liveUpdates = true; };
+        events.onerror = () => { liveUpdates = false; };
+        events.addEventListener('expenses.created', e => applyExpenseEvent(JSON.parse(e.data)));
+        events.addEventListener('expenses.updated', e => applyExpenseEvent(JSON.parse(e.data)));
+        events.addEventListener('resync', () => window.location.reload());
+    }
+});
 
-            try {
-                const response = await fetch(`/api/expenses/${expenseId}/field`, {
-                    method: 'PATCH',
-                    headers: {
-                        'Content-Type': 'application/json',
-                    },
-                    body: JSON.stringify({
-                        [field]: value
-                    })
-                });
+function formatAmount(amount) {
+    return new Intl.NumberFormat('vi-VN').format(amount);
+}
 
-                if (!response.ok) {
-                    throw new Error('Update failed');
-                }
+function formatDate(value) {
+    // "YYYY-MM-DD HH:MM:SS" -> "DD/MM/YYYY"
+    const [year, month, day] = value.split(' ')[0].split('-');
+    return `${day}/${month}/${year}`;
+}
 
-                const data = await response.json();
-                
-                // Update UI with formatted values
-                if (field === 'amount') {
-                    this.textContent = new Intl.NumberFormat('vi-VN').format(data.amount);
-                }
-            } catch (error) {
-                console.error('Error:', error);
-                alert('Có lỗi xảy ra khi cập nhật. Vui lòng thử lại.');
-                location.reload();
-            }
-        });
+function fillExpenseRow(row, expense) {
+    row.dataset.expenseId = expense.id;
+    row.querySelector('.expense-date').textContent = formatDate(expense.date);
 
-        // Prevent new line in contenteditable
-        if (el.classList.contains('editable')) {
-            el.addEventListener('keypress', function(e) {
-                if (e.key === 'Enter') {
-                    e.preventDefault();
-                    this.blur();
-                }
+    // Leave a field alone while the user is typing in it
+    const description = row.querySelector('[data-field="description"]');
+    if (document.activeElement !== description) {
+        description.textContent = expense.description;
+    }
+    const amount = row.querySelector('[data-field="amount"]');
+    if (document.activeElement !== amount) {
+        amount.textContent = formatAmount(expense.amount);
+    }
+    const category = row.querySelector('[data-field="category"]');
+    if (document.activeElement !== category) {
+        category.value = expense.category;
+    }
+}
+
+function applyExpenseEvent(event) {
+    const rows = document.getElementById('expense-rows');
+    const template = document.getElementById('expense-row-template');
+
+    event.expenses.forEach(expense => {
+        let row = rows.querySelector(`tr[data-expense-id="${expense.id}"]`);
+        if (row) {
+            fillExpenseRow(row, expense);
+        } else if (event.type === 'expenses.created') {
+            row = template.content.firstElementChild.cloneNode(true);
+            fillExpenseRow(row, expense);
+            row.querySelectorAll('.editable, .editable-select').forEach(bindEditable);
+            rows.prepend(row);
+        }
+    });
+
+    if (event.month) {
+        document.getElementById('stat-total-month').textContent = formatAmount(event.month.total) + 'đ';
+        document.getElementById('stat-avg-per-day').textContent = formatAmount(Math.round(event.month.avg_per_day)) + 'đ';
+        document.getElementById('stat-total-transactions').textContent = event.month.count;
+    }
+}
+
+function bindEditable(el) {
+    el.addEventListener('blur', async function() {
+        const expenseId = this.closest('tr').dataset.expenseId;
+        const field = this.dataset.field;
+        let value = this.tagName.toLowerCase() === 'select' ? this.value : this.textContent.trim();
+
+        // Convert amount string to number
+        if (field === 'amount') {
+            value = parseFloat(value.replace(/[,.]/g, ''));
+        }
+
+        try {
+            const response = await fetch(`/api/expenses/${expenseId}/field`, {
+                method: 'PATCH',
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                body: JSON.stringify({
+                    [field]: value
+                })
             });
+
+            if (!response.ok) {
+                throw new Error('Update failed');
+            }
+
+            const data = await response.json();
+            
+            // Update UI with formatted values
+            if (field === 'amount') {
+                this.textContent = new Intl.NumberFormat('vi-VN').format(data.amount);
+            }
+        } catch (error) {
+            console.error('Error:', error);
+            alert('Có lỗi xảy ra khi cập nhật. Vui lòng thử lại.');
+            location.reload();
         }
     });
-}); 
\ No newline at end of file
+
+    // Prevent new line in contenteditable
+    if (el.classList.contains('editable')) {
+        el.addEventListener('keypress', function(e) {
+            if (e.key === 'Enter') {
+                e.preventDefault();
+                this.blur();
+            }
+        });
+    }
+} 
\ No newline at end of file
@@ -0,0 +1,4 @@
+import os
+
+# Keep llm's response cache in memory instead of creating llm_cache.db in the working directory
+os.environ.setdefault("LLM_CACHE_PATH", "")
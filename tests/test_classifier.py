@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+
+from classifier import CategoryClassifier
+from database import AsyncDatabase
+from llm import MessageIntent, _personalize
+
+USER_ID = 1
+
+@pytest.fixture
+def db(tmp_path):
+    return AsyncDatabase(f"sqlite:///{tmp_path / 'expenses.db'}")
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+def test_exact_match_is_certain(db):
+    classifier = CategoryClassifier()
+    run(classifier.learn(db, USER_ID, [("Cà phê Highlands", "food"), ("grab bike", "transport")]))
+
+    assert classifier.classify(USER_ID, "cà phê  highlands") == ("food", 1.0)
+    assert classifier.predict(USER_ID, "Grab bike") == "transport"
+
+def test_exact_match_overrides_llm_category(db):
+    classifier = CategoryClassifier()
+    run(classifier.learn(db, USER_ID, [("grab", "food")]))
+    result = (MessageIntent.ADD_EXPENSES, {"expenses": [
+        {"amount": 50000, "description": "Grab", "category": "transport"},
+        {"amount": 30000, "description": "xe ôm", "category": "transport"},
+    ]})
+
+    _, data = _personalize(result, lambda description: classifier.predict(USER_ID, description))
+    assert [expense["category"] for expense in data["expenses"]] == ["food", "transport"]
+
+def test_similar_description_votes_by_similarity(db):
+    classifier = CategoryClassifier()
+    run(classifier.learn(db, USER_ID, [("cafe highlands", "food"), ("grab bike", "transport")]))
+
+    category, confidence = classifier.classify(USER_ID, "highlands cafe sáng")
+    assert category == "food"
+    assert 0 < confidence <= 1
+    assert classifier.classify(USER_ID, "tiền điện tháng 5") is None
+
+def test_classify_without_loaded_model(db):
+    assert CategoryClassifier().classify(USER_ID, "phở bò") is None
+
+def test_manual_fix_replaces_example(db):
+    classifier = CategoryClassifier()
+    run(classifier.learn(db, USER_ID, [("grab", "transport"), ("phở bò", "food")]))
+    run(classifier.learn(db, USER_ID, [("Grab", "food")]))
+
+    assert classifier.classify(USER_ID, "grab") == ("food", 1.0)
+    version, _, examples = run(db.get_category_examples(USER_ID))
+    assert examples == [("phở bò", "food"), ("grab", "food")]
+    assert version == 2
+
+def test_trims_to_max_examples(db):
+    classifier = CategoryClassifier(max_examples=3)
+    run(classifier.learn(db, USER_ID, [(f"quán {i}", "food") for i in range(5)]))
+
+    assert list(run(classifier.load(db, USER_ID)).examples) == ["quán 2", "quán 3", "quán 4"]
+    _, _, examples = run(db.get_category_examples(USER_ID))
+    assert [description for description, _ in examples] == ["quán 2", "quán 3", "quán 4"]
+
+def test_load_reloads_after_another_writer(db):
+    bot, web = CategoryClassifier(), CategoryClassifier()
+    run(bot.learn(db, USER_ID, [("trà sữa", "food")]))
+    run(web.load(db, USER_ID))
+    run(web.learn(db, USER_ID, [("trà sữa", "shopping")]))
+
+    assert bot.classify(USER_ID, "trà sữa") == ("food", 1.0)
+    run(bot.load(db, USER_ID))
+    assert bot.classify(USER_ID, "trà sữa") == ("shopping", 1.0)
+
+def test_remember_mirrors_learning_write(db):
+    classifier = CategoryClassifier()
+    run(classifier.load(db, USER_ID))
+    expense = run(db.add_expense(USER_ID, 35000, "Cơm tấm", "food", "cơm tấm 35k", learn=True))
+    classifier.remember(USER_ID, [(expense.description, expense.category)])
+    model = run(classifier.load(db, USER_ID))
+
+    assert model.version == run(db.get_category_version(USER_ID)) == 1
+    assert classifier.classify(USER_ID, "cơm tấm") == ("food", 1.0)
+
+def test_expense_writes_only_teach_when_asked(db):
+    run(db.add_expense(USER_ID, 50000, "phở", "food", "phở 50k"))
+    run(db.add_expenses(USER_ID, [
+        {"amount": 30000, "description": "cafe", "category": "food", "learn": True},
+        {"amount": 20000, "description": "gửi xe", "category": "transport"},
+    ], "cafe 30k, gửi xe 20k"))
+    expense = run(db.add_expense(USER_ID, 100000, "xăng", "transport", "xăng 100k", learn=True))
+    run(db.update_expense(expense.id, user_id=USER_ID, category="bills", learn=True))
+
+    version, trained, examples = run(db.get_category_examples(USER_ID))
+    assert examples == [("cafe", "food"), ("xăng", "bills")]
+    assert (version, trained) == (3, False)
+
+def test_save_category_examples_upserts_and_trims(db):
+    run(db.save_category_examples(USER_ID, [("a", "food"), ("b", "food"), ("c", "food")]))
+    version = run(db.save_category_examples(USER_ID, [("a", "shopping"), ("d", "food")], keep=3, trained=True))
+
+    assert version == 2
+    assert run(db.get_category_examples(USER_ID)) == (2, True, [("c", "food"), ("a", "shopping"), ("d", "food")])
+    assert run(db.get_category_examples(USER_ID + 1)) == (0, False, [])
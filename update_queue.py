@@ -0,0 +1,84 @@
+import asyncio
+import logging
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+class QueueFull(Exception):
+    pass
+
+class UpdateQueue:
+    """
+    Acknowledge-then-process queue for Telegram webhook updates.
+
+    Each user has their own FIFO of pending updates and at most one worker on it
+    at a time, so a user's updates run strictly in order while different users
+    are processed concurrently by the worker pool. Updates whose update_id was
+    already accepted are dropped, which absorbs Telegram's retries.
+    """
+
+    def __init__(self, process, workers: int = 8, max_size: int = 1000, dedup_size: int = 10000):
+        self._process = process
+        self._workers = workers
+        self._max_size = max_size
+        self._dedup_size = dedup_size
+        self._pending = {}
+        self._scheduled = set()
+        self._ready = None
+        self._seen = OrderedDict()
+        self._tasks = []
+        self._size = 0
+
+    @property
+    def depth(self) -> int:
+        """Number of accepted updates not yet processed."""
+        return self._size
+
+    def start(self):
+        self._ready = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self._workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def put(self, update_id: int, user_id, update) -> bool:
+        """
+        Queues an update for processing. Returns False for a duplicate update_id
+        and raises QueueFull when max_size updates are already waiting.
+        """
+        if update_id in self._seen:
+            return False
+        if self._size >= self._max_size:
+            raise QueueFull()
+
+        self._seen[update_id] = True
+        while len(self._seen) > self._dedup_size:
+            self._seen.popitem(last=False)
+
+        # Updates without a user have nothing to be ordered against
+        key = user_id if user_id is not None else ("update", update_id)
+        self._pending.setdefault(key, deque()).append(update)
+        self._size += 1
+        if key not in self._scheduled:
+            self._scheduled.add(key)
+            self._ready.put_nowait(key)
+        return True
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            update = self._pending[key].popleft()
+            try:
+                await self._process(update)
+            except Exception:
+                logger.exception("Error processing update")
+            finally:
+                self._size -= 1
+                if self._pending[key]:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._pending[key]
+                    self._scheduled.discard(key)
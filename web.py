@@ -1,22 +1,34 @@
-from fastapi import FastAPI, Request, Form, HTTPException, Query, Depends
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+from fastapi import FastAPI, Request, Form, HTTPException, Query, Depends, UploadFile, File
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse, Response, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from datetime import datetime, timedelta
+import io
 import json
+import asyncio
+import time
+import hashlib
 from typing import Optional
-from database import Database, Expense
-from llm import analyze_message, format_expense_message, MessageIntent
+from database import create_async_database
+from llm import analyze_message_async, format_expense_message, MessageIntent
+from update_queue import UpdateQueue, QueueFull
+import metrics
+from importer import import_statement, make_job_id, spool_statement
+from exporter import export_expenses, export_filename, EXPORT_FORMATS
+from classifier import is_confident, remember_expenses, train_from_history
+from events import broker, publish_expenses, publish_resync, current_month_start, expense_payload, DASHBOARD_RECENT_LIMIT
 from starlette.middleware.sessions import SessionMiddleware
 from pydantic import BaseModel
-from telegram import Update
-from telegram.ext import Application
 import os
-from bot import setup_bot
+
+API_PAGE_SIZE = int(os.getenv('API_PAGE_SIZE', 100))
+API_MAX_PAGE_SIZE = 500
+SSE_KEEPALIVE = float(os.getenv('SSE_KEEPALIVE', 15))
+API_ETAG_WINDOW = int(os.getenv('API_ETAG_WINDOW', 60))
 
 app = FastAPI()
 app.add_middleware(SessionMiddleware, secret_key="your-secret-key")  # Thay thế bằng secret key thực
-db = Database()
+db = create_async_database()
 
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -28,11 +40,32 @@ class ExpenseUpdate(BaseModel):
     description: Optional[str] = None
     category: Optional[str] = None
 
-# Initialize Telegram bot
+# Initialize Telegram bot (the telegram library and bot handlers only load when a token is set)
 bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
+webhook_secret = os.getenv('WEBHOOK_SECRET')
+application = None
+update_queue = None
 if bot_token:
-    application = Application.builder().token(bot_token).build()
-    setup_bot(application)
+    from bot import build_application
+    application = build_application(bot_token)
+    update_queue = UpdateQueue(
+        application.process_update,
+        workers=int(os.getenv('WEBHOOK_WORKERS', 8)),
+        max_size=int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000))
+    )
+    metrics.WEBHOOK_QUEUE_DEPTH.set_function(lambda: update_queue.depth)
+
+@app.on_event("startup")
+async def start_bot():
+    if application:
+        await application.initialize()
+        update_queue.start()
+
+@app.on_event("shutdown")
+async def stop_bot():
+    if application:
+        await update_queue.stop()
+        await application.shutdown()
 
 def get_current_user(request: Request) -> Optional[int]:
     user_id = request.session.get("user_id")
@@ -40,23 +73,43 @@ def get_current_user(request: Request) -> Optional[int]:
         return None
     return user_id
 
+async def conditional_etag(request: Request, user_id: int):
+    """
+    ETag for a user's API response: their change counter, the query and the
+    current API_ETAG_WINDOW-second window (so "last N days" results still move
+    as old expenses age out). Returns (etag, not_modified).
+    """
+    version = await db.get_user_version(user_id)
+    window = int(time.time() // API_ETAG_WINDOW) if API_ETAG_WINDOW > 0 else 0
+    digest = hashlib.sha1(f"{user_id}:{request.url.path}?{request.url.query}".encode()).hexdigest()[:16]
+    etag = f'W/"{version}-{window}-{digest}"'
+
+    if_none_match = request.headers.get("if-none-match", "")
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return etag, etag in candidates or "*" in candidates
+
+def cached_json(content, etag: str) -> JSONResponse:
+    return JSONResponse(content, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request, user_id: Optional[int] = Depends(get_current_user)):
     if not user_id:
         return templates.TemplateResponse("login.html", {"request": request})
         
-    # Get current month's stats
-    start_date = datetime.now().replace(day=1)
-    stats = db.get_stats(user_id=user_id, start_date=start_date)
-    total_month = sum(stats.values())
+    # Get current month's summary (cached until the user's next add or edit)
+    start_date = current_month_start()
+    summary = await db.get_dashboard_summary(user_id=user_id, start_date=start_date, recent_limit=DASHBOARD_RECENT_LIMIT)
+    total_month = summary["total"]
     
     # Calculate average per day
     days_in_month = (datetime.now() - start_date).days + 1
     avg_per_day = total_month / days_in_month if days_in_month > 0 else 0
     
     # Get total transactions
-    expenses = db.get_expenses(user_id=user_id, start_date=start_date)
-    total_transactions = len(expenses)
+    total_transactions = summary["count"]
     
     # Get all unique categories
     categories = [
@@ -73,7 +126,7 @@ async def home(request: Request, user_id: Optional[int] = Depends(get_current_us
             "avg_per_day": avg_per_day,
             "total_transactions": total_transactions,
             "categories": categories,
-            "expenses": expenses
+            "expenses": summary["recent"]
         }
     )
 
@@ -92,25 +145,40 @@ async def get_expenses(
     request: Request,
     days: Optional[int] = 7,
     category: Optional[str] = None,
+    limit: int = Query(API_PAGE_SIZE, ge=1, le=API_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
     user_id: Optional[int] = Depends(get_current_user)
 ):
+    """
+    One page of expenses, oldest first. Pass the returned next_cursor back as
+    `cursor` to get the following page; it is null on the last page.
+    """
     if not user_id:
         raise HTTPException(status_code=401, detail="Not authenticated")
+
+    etag, unchanged = await conditional_etag(request, user_id)
+    if unchanged:
+        return not_modified(etag)
         
     start_date = datetime.now() - timedelta(days=days)
-    expenses = db.get_expenses(user_id=user_id, start_date=start_date)
-    
-    if category:
-        expenses = [e for e in expenses if e.category == category]
+    try:
+        expenses, next_cursor = await db.get_expenses_page(
+            user_id=user_id, start_date=start_date, category=category, limit=limit, cursor=cursor
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
     
-    return [{
-        "id": expense.id,
-        "amount": expense.amount,
-        "description": expense.description,
-        "category": expense.category,
-        "date": expense.date.strftime("%Y-%m-%d %H:%M:%S"),
-        "raw_text": expense.raw_text
-    } for expense in expenses]
+    return cached_json({
+        "expenses": [{
+            "id": expense.id,
+            "amount": expense.amount,
+            "description": expense.description,
+            "category": expense.category,
+            "date": expense.date.strftime("%Y-%m-%d %H:%M:%S"),
+            "raw_text": expense.raw_text
+        } for expense in expenses],
+        "next_cursor": next_cursor
+    }, etag)
 
 @app.patch("/api/expenses/{expense_id}/field")
 async def update_expense_field(
@@ -121,28 +189,23 @@ async def update_expense_field(
     if not user_id:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    expense = db.session.query(Expense).filter_by(id=expense_id, user_id=user_id).first()
+    # A corrected category or description is the strongest signal for the user's classifier
+    learn = field_update.category is not None or field_update.description is not None
+    # Update only the provided fields
+    expense = await db.update_expense(
+        expense_id,
+        user_id=user_id,
+        amount=field_update.amount,
+        description=field_update.description,
+        category=field_update.category,
+        learn=learn
+    )
     if not expense:
         raise HTTPException(status_code=404, detail="Expense not found")
-    
-    # Update only the provided fields
-    if field_update.amount is not None:
-        expense.amount = field_update.amount
-    if field_update.description is not None:
-        expense.description = field_update.description
-    if field_update.category is not None:
-        expense.category = field_update.category
-        
-    db.session.commit()
-    
-    return {
-        "id": expense.id,
-        "amount": expense.amount,
-        "description": expense.description,
-        "category": expense.category,
-        "date": expense.date.strftime("%Y-%m-%d %H:%M:%S"),
-        "raw_text": expense.raw_text
-    }
+    if learn:
+        remember_expenses(user_id, [expense])
+    await publish_expenses(db, user_id, "updated", [expense])
+    return expense_payload(expense)
 
 @app.post("/api/expenses")
 async def add_expense(
@@ -152,42 +215,168 @@ async def add_expense(
     if not user_id:
         raise HTTPException(status_code=401, detail="Not authenticated")
         
-    intent, expense_info = analyze_message(raw_text)
+    await train_from_history(db, user_id)
+    intent, expense_info = await analyze_message_async(raw_text, user_id=user_id)
+    if intent == MessageIntent.ADD_EXPENSES:
+        items = [item for item in expense_info.get("expenses", []) if item.get("amount") is not None]
+        if not items:
+            raise HTTPException(status_code=400, detail="Could not extract expense information")
+
+        items = [dict(item, learn=is_confident(item)) for item in items]
+        expenses = await db.add_expenses(user_id=user_id, expenses=items, raw_text=raw_text)
+        remember_expenses(user_id, [expense for expense, item in zip(expenses, items) if item["learn"]])
+        await publish_expenses(db, user_id, "created", expenses)
+        return {
+            "expenses": [expense_payload(expense) for expense in expenses],
+            "message": format_expense_message({"expenses": items})
+        }
+
     if intent != MessageIntent.ADD_EXPENSE or expense_info["amount"] is None:
         raise HTTPException(status_code=400, detail="Could not extract expense information")
     
-    expense = db.add_expense(
+    expense = await db.add_expense(
         user_id=user_id,
         amount=expense_info["amount"],
         description=expense_info["description"],
         category=expense_info["category"],
-        raw_text=raw_text
+        raw_text=raw_text,
+        learn=is_confident(expense_info)
     )
+    if is_confident(expense_info):
+        remember_expenses(user_id, [expense])
     
-    return {
-        "id": expense.id,
-        "amount": expense.amount,
-        "description": expense.description,
-        "category": expense.category,
-        "date": expense.date.strftime("%Y-%m-%d %H:%M:%S"),
-        "raw_text": expense.raw_text
-    }
+    await publish_expenses(db, user_id, "created", [expense])
+    return expense_payload(expense)
 
 @app.get("/api/stats")
 async def get_stats(
+    request: Request,
     days: Optional[int] = 7,
     user_id: Optional[int] = Depends(get_current_user)
 ):
     if not user_id:
         raise HTTPException(status_code=401, detail="Not authenticated")
+
+    etag, unchanged = await conditional_etag(request, user_id)
+    if unchanged:
+        return not_modified(etag)
         
     start_date = datetime.now() - timedelta(days=days)
-    stats = db.get_stats(user_id=user_id, start_date=start_date)
-    return stats
+    stats = await db.get_stats(user_id=user_id, start_date=start_date)
+    return cached_json(stats, etag)
+
+@app.get("/api/export")
+async def export(
+    format: str = "csv",
+    days: Optional[int] = None,
+    user_id: Optional[int] = Depends(get_current_user)
+):
+    """Streams all of the user's expenses (or the last `days` days) as CSV, JSONL or Parquet."""
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    start_date = datetime.now() - timedelta(days=days) if days else None
+    try:
+        content = export_expenses(db, user_id, format, start_date=start_date)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return StreamingResponse(
+        content,
+        media_type=EXPORT_FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="{export_filename(format)}"'}
+    )
+
+@app.get("/api/events")
+async def events(request: Request, user_id: Optional[int] = Depends(get_current_user)):
+    """
+    Server-Sent Events stream of the user's expense changes, from the web and
+    the Telegram bot alike, so an open dashboard can patch itself in place.
+    """
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    queue = broker.subscribe(user_id)
+
+    async def stream():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=SSE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+        finally:
+            broker.unsubscribe(user_id, queue)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/api/imports")
+async def import_expenses(
+    file: UploadFile = File(...),
+    job_id: Optional[str] = Form(None),
+    user_id: Optional[int] = Depends(get_current_user)
+):
+    """
+    Imports a bank or e-wallet CSV statement and streams progress as one JSON
+    object per line. Uploading the same file again resumes an unfinished import.
+    """
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    # UploadFile.file is a SpooledTemporaryFile, which TextIOWrapper can only wrap from Python 3.11
+    spool, size, digest = await asyncio.to_thread(spool_statement, file.file)
+    job_id = job_id or make_job_id(user_id, size, digest)
+    lines = io.TextIOWrapper(spool, encoding="utf-8-sig", errors="replace", newline="")
+    progress = import_statement(db, user_id, lines, job_id, file.filename)
+
+    # Run the first batch before answering so a bad file is still a 400
+    try:
+        first = await progress.__anext__()
+    except ValueError as e:
+        lines.close()
+        raise HTTPException(status_code=400, detail=str(e))
+
+    async def stream():
+        try:
+            yield json.dumps(first) + "\n"
+            async for item in progress:
+                yield json.dumps(item) + "\n"
+        finally:
+            lines.close()
+        publish_resync(user_id)
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@app.get("/api/imports/{job_id}")
+async def get_import(job_id: str, user_id: Optional[int] = Depends(get_current_user)):
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    job = await db.get_import_job(job_id, user_id=user_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Import job not found")
+
+    return {
+        "job_id": job.id,
+        "filename": job.filename,
+        "status": job.status,
+        "rows_done": job.rows_done,
+        "rows_imported": job.rows_imported,
+        "updated_at": job.updated_at.strftime("%Y-%m-%d %H:%M:%S")
+    }
 
 @app.get("/api/expenses/{expense_id}")
 async def get_expense(expense_id: int):
-    expense = db.session.query(Expense).filter_by(id=expense_id).first()
+    expense = await db.get_expense(expense_id)
     if not expense:
         raise HTTPException(status_code=404, detail="Expense not found")
     
@@ -206,7 +395,7 @@ async def edit_expense_with_text(
     edit_text: str = Form(...),
 ):
     # Get existing expense
-    expense = db.session.query(Expense).filter_by(id=expense_id).first()
+    expense = await db.get_expense(expense_id)
     if not expense:
         raise HTTPException(status_code=404, detail="Expense not found")
     
@@ -216,42 +405,64 @@ async def edit_expense_with_text(
         "description": expense.description,
         "category": expense.category
     }
-    intent, expense_info = analyze_message(edit_text, current_expense)
+    intent, expense_info = await analyze_message_async(edit_text, current_expense)
     
     if intent != MessageIntent.EDIT_EXPENSE:
         raise HTTPException(status_code=400, detail="Invalid edit command")
     
     # Update expense
-    expense.amount = expense_info["amount"] if expense_info["amount"] is not None else expense.amount
-    expense.description = expense_info["description"] if expense_info["description"] is not None else expense.description
-    expense.category = expense_info["category"] if expense_info["category"] is not None else expense.category
-    expense.raw_text = edit_text
-    db.session.commit()
+    learn = (expense_info["description"] is not None or expense_info["category"] is not None) \
+        and is_confident(expense_info)
+    expense = await db.update_expense(
+        expense_id,
+        amount=expense_info["amount"],
+        description=expense_info["description"],
+        category=expense_info["category"],
+        raw_text=edit_text,
+        learn=learn
+    )
+    if learn:
+        remember_expenses(expense.user_id, [expense])
     
+    await publish_expenses(db, expense.user_id, "updated", [expense])
     return {
         "message": format_expense_message(expense_info, is_edit=True),
-        "expense": {
-            "id": expense.id,
-            "amount": expense.amount,
-            "description": expense.description,
-            "category": expense.category,
-            "date": expense.date.strftime("%Y-%m-%d %H:%M:%S"),
-            "raw_text": expense.raw_text
-        }
+        "expense": expense_payload(expense)
     }
 
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus scrape endpoint."""
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
 @app.post("/webhook")
 async def webhook(request: Request):
+    """Validates and queues the update, then answers Telegram right away."""
+    if application is None:
+        raise HTTPException(status_code=503, detail="Telegram bot is not configured")
+    if webhook_secret and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != webhook_secret:
+        raise HTTPException(status_code=403, detail="Invalid secret token")
+
+    from telegram import Update
     try:
         update_data = await request.json()
         update = Update.de_json(update_data, application.bot)
-        await application.process_update(update)
-        return {"status": "ok"}
     except Exception as e:
         return JSONResponse(
-            status_code=500,
+            status_code=400,
             content={"status": "error", "message": str(e)}
         )
+    if update is None:
+        return JSONResponse(status_code=400, content={"status": "error", "message": "Empty update"})
+
+    user_id = update.effective_user.id if update.effective_user else None
+    try:
+        if not update_queue.put(update.update_id, user_id, update):
+            return {"status": "duplicate"}
+    except QueueFull:
+        # Telegram retries on errors, so back-pressure is safe here
+        return JSONResponse(status_code=503, content={"status": "error", "message": "Queue is full"})
+    return {"status": "ok"}
 
 if __name__ == "__main__":
     import uvicorn